@@ -18,11 +18,35 @@ from __future__ import unicode_literals
 
 import json
 import os
+import socket
+import ssl
+import time
 
 import requests
 
 import requests_unixsocket
 
+from .deadline import DeadlineExceeded, DeadlineTimeout
+from .limiter import Slot
+from .timing import OperationSpan
+
+try:
+    import http.client as http_client
+except ImportError:  # python 2
+    import httplib as http_client
+
+
+RAW_CONTENT_TYPES = ('application/octet-stream', 'multipart/', 'text/')
+
+STREAM_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+"""
+Requests errors raised by timeouts, read timeouts while streaming a
+response are raised as ``ConnectionError``.
+"""
+
 
 class APIException(Exception):
     """
@@ -30,7 +54,7 @@ class APIException(Exception):
 
     It will try to find the error message in the HTTP response and
     use it if it find it, otherwise will use the response data as
-    message.
+    message, or the status code and start of the text of a raw response.
 
     .. attribute:: result
 
@@ -50,8 +74,10 @@ class APIException(Exception):
 
         if 'error' in result.data:
             message.append(result.data['error'])
-        elif 'err' in result.metadata:
+        elif result.metadata and 'err' in result.metadata:
             message.append(result.metadata['err'])
+        elif APIResult.is_raw(result.response):
+            message.append(raw_error(result.response))
         else:
             message.append(json.dumps(result.data, indent=4))
 
@@ -72,7 +98,9 @@ class APIResult(object):
 
     .. attribute:: data
 
-        JSON data from the response.
+        JSON data from the response, an empty dict for raw responses such as
+        file contents, which should be read from :attr:`response` instead,
+        or plain text errors such as an unsatisfiable range.
 
     .. attribute:: request
 
@@ -81,15 +109,60 @@ class APIResult(object):
     .. attribute:: response
 
         Response object from the requests library.
+
+    .. attribute:: span
+
+        :class:`~lxdapi.timing.OperationSpan` if the request created an
+        async operation, None otherwise.
+
+    .. attribute:: deadline
+
+        :class:`~lxdapi.deadline.Deadline` the request was made with, also
+        used by :meth:`wait()`.
     """
 
     def __init__(self, api, response):
         """Construct a :class:`APIResult` with an :class:`API` and response."""
         self.api = api
-        self.data = response.json()
+        self.data = {} if self.is_raw(response) else response.json()
         self.metadata = self.data.get('metadata', None)
         self.response = response
         self.request = response.request
+        self.span = None
+        self.deadline = None
+
+    @staticmethod
+    def is_raw(response):
+        """Return True if the response is not a JSON document."""
+        content_type = response.headers.get('Content-Type', '')
+        return content_type.startswith(RAW_CONTENT_TYPES)
+
+    def iter_content(self, chunk_size):
+        """
+        Return an iterator of chunks of a streamed response.
+
+        With a :attr:`deadline`, :class:`~lxdapi.deadline.DeadlineExceeded`
+        is raised once it expires, and for read timeouts.
+        """
+        chunks = self.response.iter_content(chunk_size)
+
+        if not self.deadline:
+            return chunks
+
+        return self.bounded(chunks)
+
+    def bounded(self, chunks):
+        """Yield chunks within :attr:`deadline`."""
+        description = '%s %s' % (self.request.method, self.request.url)
+
+        try:
+            for chunk in self.deadline.chunks(chunks, description):
+                yield chunk
+        except STREAM_ERRORS as e:
+            if not timed_out(e, self.deadline):
+                raise
+            raise DeadlineTimeout('%s: deadline of %ss exceeded: %s' % (
+                description, self.deadline.seconds, e))
 
     def request_summary(self):
         """Return a string with the request method, url, and data."""
@@ -146,12 +219,34 @@ class APIResult(object):
         self.validate_metadata(self.data)
 
     def wait(self, timeout=None):
-        """Execute the wait API call for the operation in this result."""
-        timeout = timeout or self.api.default_timeout
+        """
+        Execute the wait API call for the operation in this result.
+
+        Once the operation is done, :attr:`span` is completed and added to
+        :attr:`API.spans` if set.
+
+        If the result has a :attr:`deadline`, the timeout is capped to it,
+        and :class:`~lxdapi.deadline.DeadlineExceeded` is raised if the
+        operation is still running when the wait returns.
+        """
+        timeout = self.api.timeout(timeout or None, self.deadline)
 
-        return self.api.get(
-            '%s/wait?timeout=%s' % (self.data['operation'], timeout)
+        result = self.api.get(
+            '%s/wait?timeout=%s' % (self.data['operation'], timeout),
+            deadline=self.deadline,
         )
+        done = result.metadata.get('status_code', 0) >= 200
+
+        if self.deadline and not done:
+            raise DeadlineExceeded('%s: still %s after the deadline' % (
+                self.data['operation'], result.metadata.get('status')))
+
+        if self.span and done:
+            self.span.finish(result.metadata, time.time())
+            if self.api.spans is not None:
+                self.api.spans.add(self.span)
+
+        return result
 
 
 class API(object):
@@ -168,6 +263,22 @@ class API(object):
 
         api = lxd.API.factory()
         api.post('images', json=data_dict).wait()
+
+    .. attribute:: limiter
+
+        Optional :class:`~lxdapi.limiter.Limiter` for the requests of this
+        :class:`API`.
+
+    .. attribute:: host_limiter
+
+        Optional :class:`~lxdapi.limiter.Limiter` shared by the
+        :class:`API` objects of a host, see
+        :meth:`~lxdapi.limiter.Limiter.host`.
+
+    .. attribute:: spans
+
+        Optional :class:`~lxdapi.timing.SpanAggregator` collecting the
+        :attr:`APIResult.span` of waited operations.
     """
 
     @classmethod
@@ -204,12 +315,16 @@ class API(object):
             **kwargs
         )
 
-    def __init__(self, session, endpoint, default_version=None, debug=False):
+    def __init__(self, session, endpoint, default_version=None, debug=False,
+                 limiter=None, host_limiter=None):
         self.endpoint = endpoint[:-1] if endpoint.endswith('/') else endpoint
         self.default_timeout = 30
         self.default_version = default_version
         self.session = session
         self.debug = debug or os.environ.get('DEBUG', False)
+        self.limiter = limiter
+        self.host_limiter = host_limiter
+        self.spans = None
 
     def format_url(self, url):
         """
@@ -237,20 +352,98 @@ class API(object):
         If :attr:`debug` is True, then this will dump HTTP request and response
         data.
 
-        Extra args and kwargs are passed to ``requests.Session.request()``.
+        Extra args and kwargs are passed to ``requests.Session.request()``,
+        pass ``stream=True`` to read raw responses such as file contents in
+        chunks from ``result.response``.
+
+        Pass a :class:`~lxdapi.deadline.Deadline` as ``deadline`` to use the
+        remaining budget as connect and read timeouts, and to raise
+        :class:`~lxdapi.deadline.DeadlineExceeded` instead of sending the
+        request or waiting past it. Waiting on the result uses the same
+        deadline.
         """
         url = self.format_url(url)
+        deadline = kwargs.pop('deadline', None)
 
         if self.debug:
             print(method, url)
             if 'json' in kwargs:
                 print(json.dumps(kwargs['json'], indent=4))
 
-        result = APIResult(
-            self,
-            self.session.request(method, url, **kwargs),
+        sample = not streamed(kwargs.get('data'))
+
+        with self.slot(url, deadline, sample) as slot:
+            sent = slot.start
+            response = self.send(method, url, deadline, **kwargs)
+            slot.error = response.status_code >= 500
+
+        result = self.result(response)
+        result.deadline = deadline
+
+        if result.data.get('type') == 'async':
+            result.span = OperationSpan.from_result(result, sent)
+
+        return result
+
+    def send(self, method, url, deadline=None, **kwargs):
+        """
+        Call ``session.request()`` with timeouts capped to deadline.
+
+        A streamed body, a file or an iterator, is checked against the
+        deadline as it is sent.
+        """
+        if not deadline:
+            return self.session.request(method, url, **kwargs)
+
+        description = '%s %s' % (method, url)
+        kwargs.setdefault('timeout', deadline.timeout(description))
+        kwargs['data'] = bounded(kwargs.get('data'), deadline, description)
+
+        try:
+            return self.session.request(method, url, **kwargs)
+        except STREAM_ERRORS as e:
+            if not timed_out(e, deadline):
+                raise
+            raise DeadlineTimeout('%s: deadline of %ss exceeded: %s' % (
+                description, deadline.seconds, e))
+
+    def timeout(self, timeout=None, deadline=None):
+        """
+        Return a timeout for LXD, capped to the deadline if any.
+
+        Timeout defaults to :attr:`default_timeout`, this is used for
+        operation waits and action timeouts such as stop.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return deadline.cap(timeout) if deadline else timeout
+
+    def slot(self, url, deadline=None, sample=True):
+        """
+        Return a :class:`~lxdapi.limiter.Slot` for a request to url.
+
+        It holds a slot in :attr:`limiter` and :attr:`host_limiter` if any.
+        Operation waits hold a slot, so that running operations count as
+        in-flight, but their latency doesn't adapt the limits since they
+        are long polling. Pass sample=False for other requests which take
+        as long as their body, such as uploads. Waiting for the slot is
+        bounded by deadline.
+        """
+        return Slot(
+            [self.limiter, self.host_limiter],
+            sample=sample and '/wait?' not in url,
+            deadline=deadline,
         )
 
+    def result(self, response):
+        """
+        Return a validated :class:`APIResult` for a requests response.
+
+        This is where the response is dumped if :attr:`debug` is True.
+        """
+        result = APIResult(self, response)
+
         if self.debug:
             print(result.response_summary())
             print('=' * 24)
@@ -259,6 +452,124 @@ class API(object):
 
         return result
 
+    def connect(self, timeout=None):
+        """
+        Return a socket connected to the endpoint.
+
+        This is for transactions which requests can't do, such as
+        :meth:`sendfile()` or websockets. For https endpoints, the socket is
+        wrapped with the session's ``cert`` and ``verify`` settings.
+        """
+        url = requests.compat.urlparse(self.endpoint)
+
+        if url.scheme == 'http+unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(requests.compat.unquote(url.netloc))
+            return sock
+
+        sock = socket.create_connection((url.hostname, url.port or 8443), timeout)
+
+        if url.scheme == 'https':
+            sock = self.wrap_ssl(sock, url.hostname)
+
+        return sock
+
+    def wrap_ssl(self, sock, hostname):
+        """Wrap a socket with the session's client certificate and CA."""
+        context = ssl.create_default_context()
+        verify = self.session.verify
+
+        if isinstance(verify, requests.compat.basestring):
+            context.load_verify_locations(verify)
+        elif not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        if self.session.cert:
+            cert = self.session.cert
+            context.load_cert_chain(*(cert if isinstance(cert, tuple) else (cert,)))
+
+        return context.wrap_socket(sock, server_hostname=hostname)
+
+    def sendfile(self, method, url, fileobj, headers=None, params=None,
+                 deadline=None):
+        """
+        Execute an HTTP request with a file as body, return an APIResult.
+
+        The file is sent from its current position to its end with
+        ``socket.sendfile()`` which uses zero-copy ``os.sendfile()`` where
+        the platform supports it, instead of copying it through Python
+        buffers like requests does. With a deadline, the remaining budget
+        is the socket timeout.
+        """
+        request = requests.Request(
+            method,
+            self.format_url(url),
+            headers=headers,
+            params=params,
+        ).prepare()
+        request.headers['Content-Length'] = str(
+            os.fstat(fileobj.fileno()).st_size - fileobj.tell())
+
+        if self.debug:
+            print(method, request.url, '<', fileobj.name)
+
+        with self.slot(request.url, deadline, sample=False) as slot:
+            response = self.transmit(request, fileobj, deadline)
+            slot.error = response.status_code >= 500
+
+        result = self.result(response)
+        result.deadline = deadline
+        return result
+
+    def transmit(self, request, fileobj, deadline=None):
+        """Send request with fileobj as body on a new socket, read response."""
+        sock = self.connect(self.socket_timeout(request, deadline))
+
+        try:
+            sock.sendall(self.format_head(request))
+            send_file(sock, fileobj, deadline=deadline)
+            return self.read_response(sock, request)
+        except socket.timeout as e:
+            raise DeadlineTimeout('%s %s: deadline of %ss exceeded: %s' % (
+                request.method, request.url, deadline.seconds, e))
+        finally:
+            sock.close()
+
+    @staticmethod
+    def socket_timeout(request, deadline):
+        """Return the remaining seconds of deadline if any, or None."""
+        if not deadline:
+            return None
+
+        return deadline.timeout('%s %s' % (request.method, request.url))
+
+    @staticmethod
+    def format_head(request):
+        """Return the request line and headers of a prepared request."""
+        url = requests.compat.urlparse(request.url)
+        path = url.path + ('?' + url.query if url.query else '')
+        lines = ['%s %s HTTP/1.1' % (request.method, path), 'Host: lxd']
+        lines += ['%s: %s' % header for header in request.headers.items()]
+        lines += ['Connection: close', '', '']
+        return '\r\n'.join(lines).encode('latin-1')
+
+    @staticmethod
+    def read_response(sock, request):
+        """Read an HTTP response from sock into a requests response."""
+        raw = http_client.HTTPResponse(sock)
+        raw.begin()
+
+        response = requests.Response()
+        response.status_code = raw.status
+        response.headers = requests.structures.CaseInsensitiveDict(
+            raw.getheaders())
+        response._content = raw.read()
+        response.request = request
+        response.url = request.url
+        return response
+
     def delete(self, url, *args, **kwargs):
         """Calls :meth:`request()` with ``method=DELETE``."""
         return self.request('DELETE', url, *args, **kwargs)
@@ -274,3 +585,49 @@ class API(object):
     def put(self, url, *args, **kwargs):
         """Calls :meth:`request()` with ``method=PUT``."""
         return self.request('PUT', url, *args, **kwargs)
+
+
+def send_file(sock, fileobj, chunk_size=1024 * 1024, deadline=None):
+    """
+    Send fileobj on sock, zero-copy where ``socket.sendfile()`` exists.
+
+    The file is sent from its current position in chunks of chunk_size,
+    with a :class:`~lxdapi.deadline.Deadline` checked between chunks.
+    """
+    while send_chunk(sock, fileobj, chunk_size):
+        if deadline:
+            deadline.check('sendfile %s' % getattr(fileobj, 'name', ''))
+
+
+def send_chunk(sock, fileobj, chunk_size):
+    """Send up to chunk_size bytes of fileobj on sock, return how many."""
+    if hasattr(sock, 'sendfile'):
+        return sock.sendfile(fileobj, fileobj.tell(), chunk_size)
+
+    # python 2 has no socket.sendfile()
+    chunk = fileobj.read(chunk_size)
+    sock.sendall(chunk)
+    return len(chunk)
+
+
+def streamed(data):
+    """Return True if data is a request body read as it's sent."""
+    return any(hasattr(data, name) for name in ('read', 'next', '__next__'))
+
+
+def raw_error(response, length=200):
+    """Return the status code and up to length characters of a response."""
+    text = response.text.strip()
+    if len(text) > length:
+        text = text[:length] + '...'
+    return '%s %s' % (response.status_code, text)
+
+
+def bounded(data, deadline, description):
+    """Return a request body checked against deadline if it's streamed."""
+    return deadline.stream(data, description) if streamed(data) else data
+
+
+def timed_out(error, deadline):
+    """Return True if a requests error is a timeout or happened past deadline."""
+    return isinstance(error, requests.exceptions.Timeout) or deadline.expired
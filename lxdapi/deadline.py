@@ -0,0 +1,122 @@
+"""
+End-to-end time budgets for HTTP transactions and operation waits.
+
+A :class:`Deadline` is created once for a reconcile step and passed as
+``deadline`` to :meth:`~lxdapi.api.API.request` and to the shortcuts. Each
+request then gets the remaining budget as its connect and read timeouts,
+operation waits and LXD action timeouts are capped to it, so the step
+either completes within the budget or raises :class:`DeadlineExceeded`.
+Streamed request and response bodies are checked against it between
+chunks::
+
+    deadline = Deadline(60)
+    container_absent(api, container_get(api, 'foo', deadline=deadline),
+                     deadline=deadline)
+"""
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a transaction can't complete before its deadline."""
+
+
+class DeadlineTimeout(DeadlineExceeded, IOError):
+    """
+    Raised when a socket timed out on the deadline while in a transaction.
+
+    Unlike other :class:`DeadlineExceeded`, it's an IOError, so that
+    :class:`~lxdapi.limiter.Slot` reports it as a daemon error.
+    """
+
+
+class Deadline(object):
+    """
+    Time budget of seconds starting at construction.
+
+    .. attribute:: expires
+
+        Epoch time at which the deadline expires.
+    """
+
+    def __init__(self, seconds):
+        """Construct a Deadline expiring in seconds."""
+        self.seconds = seconds
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        """Return the seconds left, 0 once expired."""
+        return max(self.expires - time.time(), 0)
+
+    @property
+    def expired(self):
+        """True once there's no time left."""
+        return not self.remaining()
+
+    def check(self, description):
+        """Raise :class:`DeadlineExceeded` for description if expired."""
+        self.timeout(description)
+
+    def timeout(self, description):
+        """
+        Return the remaining seconds to use as a socket timeout.
+
+        Raise :class:`DeadlineExceeded` for description if expired, since a
+        timeout of 0 would make a socket non-blocking.
+        """
+        remaining = self.remaining()
+
+        if not remaining:
+            raise DeadlineExceeded('%s: deadline of %ss exceeded' % (
+                description, self.seconds))
+
+        return remaining
+
+    def stream(self, body, description):
+        """
+        Return a request body raising :class:`DeadlineExceeded` once expired.
+
+        Body is a file, which is wrapped in a :class:`DeadlineReader`, or an
+        iterable of chunks.
+        """
+        if hasattr(body, 'read'):
+            return DeadlineReader(body, self, description)
+        return self.chunks(body, description)
+
+    def chunks(self, chunks, description):
+        """Yield chunks, raise :class:`DeadlineExceeded` once expired."""
+        for chunk in chunks:
+            self.check(description)
+            yield chunk
+
+    def cap(self, timeout):
+        """
+        Return timeout capped to the remaining whole seconds.
+
+        LXD timeouts are integers, so a timeout is never capped under 1
+        second, use :meth:`check()` to fail once expired.
+        """
+        return min(timeout, max(int(self.remaining()), 1))
+
+
+class DeadlineReader(object):
+    """
+    File wrapper checking a :class:`Deadline` before each read.
+
+    Other attributes are those of the file, so that requests still sends
+    it with a Content-Length.
+    """
+
+    def __init__(self, fileobj, deadline, description):
+        """Construct a DeadlineReader for a file, deadline and description."""
+        self.fileobj = fileobj
+        self.deadline = deadline
+        self.description = description
+
+    def read(self, *args):
+        """Read from the file, raise :class:`DeadlineExceeded` if expired."""
+        self.deadline.check(self.description)
+        return self.fileobj.read(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
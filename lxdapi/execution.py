@@ -0,0 +1,311 @@
+"""
+Run commands in containers with their stdio attached to websockets.
+
+This module provides 2 classes:
+
+- :class:`Execution`: starts an exec operation and attaches its websockets,
+- :class:`Multiplexer`: writes stdin to and reads output from the websockets
+  of any number of :class:`Execution` in a single thread with non-blocking
+  I/O.
+
+The :func:`~lxdapi.shortcuts.container_exec` and
+:func:`~lxdapi.shortcuts.containers_exec` shortcuts wrap them.
+"""
+
+import collections
+import select
+
+from .websocket import OPCODE_CLOSE, WebSocket
+
+try:
+    from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+except ImportError:  # python 2
+    DefaultSelector = None
+    EVENT_READ = select.POLLIN
+    EVENT_WRITE = select.POLLOUT
+
+
+STDIN_CHUNK = 64 * 1024
+"""Number of stdin bytes sent per websocket frame."""
+
+
+class Execution(object):
+    """
+    A command running in a container.
+
+    Output is captured in :attr:`stdout` and :attr:`stderr`, unless
+    ``on_stdout`` or ``on_stderr`` callbacks are given, in which case they
+    are called with each chunk of output instead.
+
+    Stdin bytes are sent by the :class:`Multiplexer` as the command reads
+    them, then the stdin websocket is closed.
+
+    .. attribute:: result
+
+        :class:`~lxdapi.api.APIResult` of the exec request.
+
+    .. attribute:: return_code
+
+        Exit code of the command, set by :meth:`finish()`.
+    """
+
+    def __init__(self, api, container, command, stdin=None, environment=None,
+                 on_stdout=None, on_stderr=None, deadline=None):
+        """Start command in container and connect the websockets."""
+        self.container = container
+        self.return_code = None
+        self.stdin = collections.deque(
+            stdin[i:i + STDIN_CHUNK]
+            for i in range(0, len(stdin or b''), STDIN_CHUNK)
+        )
+        self.output = {'1': [], '2': []}
+        self.callbacks = {
+            '1': on_stdout or self.output['1'].append,
+            '2': on_stderr or self.output['2'].append,
+        }
+
+        self.result = api.post('containers/%s/exec' % container, json={
+            'command': command,
+            'environment': environment or {},
+            'interactive': False,
+            'wait-for-websocket': True,
+        }, deadline=deadline)
+
+        self.websockets = {}
+        try:
+            self.connect(api, deadline)
+        except Exception:
+            self.shutdown()
+            raise
+
+    def connect(self, api, deadline=None):
+        """Connect the websockets, control comes last."""
+        fds = self.result.metadata['metadata']['fds']
+
+        for fd in sorted(fds):
+            self.websockets[fd] = WebSocket.connect(
+                api,
+                '%s/websocket?secret=%s' % (
+                    self.result.data['operation'], fds[fd]),
+                deadline,
+            )
+
+        # stdin is written when the multiplexer finds it writable
+        self.websockets['0'].sock.setblocking(False)
+
+    def write(self):
+        """
+        Send stdin without blocking, return False once it is closed.
+
+        Frames are queued one chunk at a time as the socket accepts them,
+        followed by a close frame. If the command exited without reading
+        all stdin, the rest is dropped.
+        """
+        try:
+            return self.feed(self.websockets['0'])
+        except (IOError, OSError):
+            self.stdin.clear()
+            return False
+
+    def feed(self, websocket):
+        """Queue and flush stdin frames, return True if more is to send."""
+        while websocket.flush():
+            if websocket.closed:
+                return False
+            if self.stdin:
+                websocket.queue(self.stdin.popleft())
+            else:
+                websocket.queue(b'', OPCODE_CLOSE)
+
+        return True
+
+    @property
+    def stdout(self):
+        """Captured stdout bytes."""
+        return b''.join(self.output['1'])
+
+    @property
+    def stderr(self):
+        """Captured stderr bytes."""
+        return b''.join(self.output['2'])
+
+    @property
+    def done(self):
+        """True when the server closed stdout and stderr."""
+        return self.websockets['1'].closed and self.websockets['2'].closed
+
+    def streams(self):
+        """
+        Return the websockets to read: stdout, stderr and control.
+
+        Messages buffered with the handshakes are dispatched first, only the
+        websockets which are still open are returned.
+        """
+        streams = [self.websockets[fd] for fd in ('1', '2', 'control')]
+
+        for websocket in streams:
+            self.dispatch(websocket, websocket.pending())
+
+        return [websocket for websocket in streams if not websocket.closed]
+
+    def handle(self, websocket):
+        """Write stdin or read output, return False once websocket is done."""
+        if websocket is self.websockets['0']:
+            return self.write()
+
+        return self.read(websocket)
+
+    def read(self, websocket):
+        """Read a readable websocket, return False once it is closed."""
+        self.dispatch(websocket, websocket.recv())
+        return not websocket.closed
+
+    def dispatch(self, websocket, messages):
+        """Pass the payload of messages to the callback of a websocket."""
+        callback = self.callbacks.get(self.fd(websocket))
+
+        for opcode, payload in messages:
+            if callback and payload:
+                callback(payload)
+
+    def fd(self, websocket):
+        """Return the fd name of a websocket."""
+        for fd, value in self.websockets.items():
+            if value is websocket:
+                return fd
+
+    def finish(self, timeout=None):
+        """Close the websockets, wait for the operation, set return_code."""
+        self.shutdown()
+        result = self.result.wait(timeout)
+        self.return_code = result.metadata['metadata']['return']
+        return self
+
+    def shutdown(self):
+        """Close all websockets."""
+        for websocket in self.websockets.values():
+            websocket.shutdown()
+
+
+SelectorKey = collections.namedtuple('SelectorKey', 'fileobj fd data')
+
+
+class PollSelector(object):
+    """Subset of ``selectors.DefaultSelector`` for python 2."""
+
+    def __init__(self):
+        self.poll = select.poll()
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        """Register a file object for events."""
+        fd = fileobj.fileno()
+        self.keys[fd] = SelectorKey(fileobj, fd, data)
+        self.poll.register(fd, events)
+
+    def unregister(self, fileobj):
+        """Unregister a file object."""
+        fd = fileobj.fileno()
+        self.poll.unregister(fd)
+        return self.keys.pop(fd)
+
+    def get_map(self):
+        """Return the mapping of file descriptors to keys."""
+        return self.keys
+
+    def select(self, timeout=None):
+        """Return the list of (key, events) ready, timeout in seconds."""
+        return [
+            (self.keys[fd], event)
+            for fd, event in self.poll.poll(
+                None if timeout is None else timeout * 1000)
+        ]
+
+
+class Multiplexer(object):
+    """
+    Write stdin and read output of many :class:`Execution` in one thread.
+
+    Example::
+
+        multiplexer = Multiplexer()
+        for container in ('foo', 'bar'):
+            multiplexer.add(Execution(api, container, ['hostname']))
+        for execution in multiplexer.run():
+            print(execution.container, execution.stdout)
+    """
+
+    def __init__(self):
+        self.selector = DefaultSelector() if DefaultSelector else PollSelector()
+        self.finished = []
+
+    def add(self, execution):
+        """Register the websockets of an execution."""
+        for websocket in execution.streams():
+            self.selector.register(websocket, EVENT_READ, execution)
+
+        self.selector.register(
+            execution.websockets['0'], EVENT_WRITE, execution)
+
+        if execution.done:
+            self.finished.append(self.unregister(execution))
+
+    def run(self, deadline=None):
+        """
+        Read until all executions are done, yield them as they finish.
+
+        If the :class:`~lxdapi.deadline.Deadline` expires first, the
+        websockets of the remaining executions are closed and
+        :class:`~lxdapi.deadline.DeadlineExceeded` is raised.
+        """
+        while self.finished:
+            yield self.finished.pop().finish()
+
+        while self.selector.get_map():
+            for key, events in self.select(deadline):
+                execution = self.handle(key)
+                if execution:
+                    yield execution.finish()
+
+    def select(self, deadline=None):
+        """Return the ready (key, events), abort if deadline expired."""
+        if not deadline:
+            return self.selector.select()
+
+        ready = self.selector.select(deadline.remaining())
+        if deadline.expired:
+            count = self.abort()
+            deadline.check('%s executions' % count)
+        return ready
+
+    def executions(self):
+        """Return the set of executions with registered websockets."""
+        return set(key.data for key in self.selector.get_map().values())
+
+    def abort(self):
+        """Close the websockets of all executions, return how many."""
+        executions = self.executions()
+
+        for execution in executions:
+            self.unregister(execution).shutdown()
+
+        return len(executions)
+
+    def handle(self, key):
+        """Handle a selected websocket, return its execution if finished."""
+        if key.fd not in self.selector.get_map():
+            return None  # execution finished earlier in this select batch
+
+        if not key.data.handle(key.fileobj):
+            self.selector.unregister(key.fileobj)
+
+        if key.data.done:
+            return self.unregister(key.data)
+
+    def unregister(self, execution):
+        """Unregister the remaining websockets of a finished execution."""
+        for websocket in execution.websockets.values():
+            if websocket.fileno() in self.selector.get_map():
+                self.selector.unregister(websocket)
+
+        return execution
@@ -0,0 +1,218 @@
+"""
+Build LXD image tarballs from a directory.
+
+:class:`ImageBuilder` makes a unified image tarball out of a directory with
+a ``metadata.yaml`` file and a ``rootfs`` directory, such as the one
+``tests/make_busybox`` prepares. The tarball is produced as an iterable of
+compressed chunks, which can be written to a file or passed as data to
+requests to stream an image upload without a temporary file.
+
+Compression is parallel: the tar stream is cut in blocks which are
+compressed concurrently by a thread pool, the compression libraries
+release the GIL, and concatenated as independent gzip members, bzip2 or xz
+streams, which their decompressors read as a single stream.
+"""
+
+import bz2
+import collections
+import hashlib
+import os
+import tarfile
+import threading
+import zlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue  # noqa
+
+try:
+    import lzma
+except ImportError:  # python 2
+    lzma = None
+
+
+def gzip_compress(data, level):
+    """Return data compressed as a gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bzip2_compress(data, level):
+    """Return data compressed as a bzip2 stream."""
+    return bz2.compress(data, level)
+
+
+def xz_compress(data, level):
+    """Return data compressed as an xz stream."""
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+def none_compress(data, level):
+    """Return data as is."""
+    return data
+
+
+CODECS = {
+    'gzip': gzip_compress,
+    'bzip2': bzip2_compress,
+    'none': none_compress,
+}
+"""Compression functions by codec name, xz needs the lzma module."""
+
+if lzma:
+    CODECS['xz'] = xz_compress
+
+
+class BlockWriter(object):
+    """File-like object putting blocks of written data in a queue."""
+
+    def __init__(self, blocks, block_size):
+        self.queue = blocks
+        self.block_size = block_size
+        self.blocks = []
+        self.size = 0
+        self.aborted = False
+
+    def write(self, data):
+        """Buffer data, put a block in the queue when there's enough."""
+        self.blocks.append(data)
+        self.size += len(data)
+
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Put the buffered data in the queue."""
+        if self.blocks:
+            self.put(b''.join(self.blocks))
+            self.blocks = []
+            self.size = 0
+
+    def put(self, item):
+        """Put an item in the queue, raise IOError if the reader aborted."""
+        while not self.aborted:
+            try:
+                return self.queue.put(item, timeout=1)
+            except queue.Full:
+                pass
+
+        raise IOError('Image build aborted')
+
+
+class ImageBuilder(object):
+    """
+    Unified image tarball built from a directory.
+
+    Iterate over the builder to get the compressed tarball in chunks, or use
+    :meth:`write()`. Once iterated, :attr:`fingerprint` is the sha256 of the
+    tarball, as :func:`~lxdapi.shortcuts.image_get_fingerprint` would
+    return for a file with the same content.
+
+    Codec is one of :data:`CODECS`, processes is the number of compression
+    threads, the number of cpus by default, and block_size the number of
+    bytes of tar stream compressed at once. The output is reproducible for
+    a given directory, codec, level and block_size.
+
+    Example::
+
+        builder = ImageBuilder('build/busybox', codec='xz')
+        with open('busybox.tar.xz', 'wb') as f:
+            builder.write(f)
+        print(builder.fingerprint)
+
+    .. attribute:: fingerprint
+
+        sha256 of the tarball, None until it was completely iterated.
+    """
+
+    def __init__(self, path, codec='gzip', level=6, processes=None,
+                 block_size=1024 * 1024):
+        """Construct an ImageBuilder for a directory."""
+        if codec not in CODECS:
+            raise Exception('Invalid codec %s, choices are: %s' % (
+                codec,
+                sorted(CODECS.keys()),
+            ))
+
+        self.path = path
+        self.compress = CODECS[codec]
+        self.level = level
+        self.processes = processes or cpu_count()
+        self.block_size = block_size
+        self.fingerprint = None
+
+    def members(self):
+        """Yield (path, arcname) for metadata.yaml, then the sorted tree."""
+        for name in sorted(os.listdir(self.path)):
+            top = os.path.join(self.path, name)
+            yield top, name
+
+            for root, directories, files in os.walk(top):
+                directories.sort()
+                for child in sorted(directories + files):
+                    path = os.path.join(root, child)
+                    yield path, os.path.relpath(path, self.path)
+
+    def tar(self, writer):
+        """Write the tar stream to a :class:`BlockWriter`, then None."""
+        try:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for path, arcname in self.members():
+                    tar.add(path, arcname, recursive=False)
+            writer.flush()
+            writer.put(None)
+        except Exception as e:
+            if not writer.aborted:
+                writer.put(e)
+
+    def blocks(self):
+        """Yield the blocks of the tar stream, tarred in a thread."""
+        blocks = queue.Queue(self.processes * 2)
+        writer = BlockWriter(blocks, self.block_size)
+        thread = threading.Thread(target=self.tar, args=(writer,))
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for block in iter(blocks.get, None):
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+        finally:
+            writer.aborted = True
+
+    def __iter__(self):
+        """Yield compressed chunks, compressing blocks in a thread pool."""
+        sha256 = hashlib.sha256()
+        pool = ThreadPool(self.processes)
+        pending = collections.deque()
+
+        try:
+            for block in self.blocks():
+                pending.append(pool.apply_async(
+                    self.compress, (block, self.level)))
+                if len(pending) > self.processes:
+                    yield self.digest(sha256, pending.popleft().get())
+
+            while pending:
+                yield self.digest(sha256, pending.popleft().get())
+        finally:
+            pool.terminate()
+
+        self.fingerprint = sha256.hexdigest()
+
+    @staticmethod
+    def digest(sha256, chunk):
+        """Update sha256 with chunk, return chunk."""
+        sha256.update(chunk)
+        return chunk
+
+    def write(self, fileobj):
+        """Write the tarball to fileobj, return the fingerprint."""
+        for chunk in self:
+            fileobj.write(chunk)
+
+        return self.fingerprint
@@ -0,0 +1,233 @@
+"""
+Adaptive concurrency limits for HTTP transactions with the LXD daemon.
+
+A :class:`Limiter` bounds the number of in-flight transactions: once the
+limit is reached, callers queue in first come, first served order. The limit
+adapts with AIMD: it grows additively by about one per limit of fast
+responses, and is cut multiplicatively when a response is slower than the
+latency target or is an error, at most once per round trip.
+
+:class:`~lxdapi.api.API` takes a ``limiter`` for its own requests and a
+``host_limiter``, shared by all :class:`~lxdapi.api.API` of a daemon, which
+:meth:`Limiter.host` returns::
+
+    api = API.factory(
+        limiter=Limiter(maximum=16),
+        host_limiter=Limiter.host('/var/lib/lxd/unix.socket'),
+    )
+"""
+
+import threading
+import time
+
+from .deadline import DeadlineExceeded
+
+
+class Limiter(object):
+    """
+    AIMD concurrency limit with a FIFO queue.
+
+    Limit is the initial limit, which stays between minimum and maximum.
+    A response is slow when it took more than latency seconds, slow
+    responses and errors multiply the limit by backoff.
+
+    .. attribute:: limit
+
+        Current limit, a float, the integer part is used.
+
+    .. attribute:: in_flight
+
+        Number of transactions holding a slot.
+
+    .. attribute:: queued
+
+        Number of transactions waiting for a slot.
+
+    .. attribute:: queue_wait
+
+        Total seconds spent waiting for a slot.
+
+    .. attribute:: max_queue_wait
+
+        Longest wait for a slot, in seconds.
+    """
+
+    hosts = {}
+    hosts_lock = threading.Lock()
+
+    def __init__(self, limit=4, minimum=1, maximum=64, latency=1.0,
+                 backoff=0.5):
+        """Construct a Limiter."""
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.queued = 0
+        self.queue_wait = 0
+        self.max_queue_wait = 0
+        self.decreased_at = 0
+        self.tickets = 0
+        self.serving = 0
+        self.abandoned = set()
+        self.condition = threading.Condition()
+
+    @classmethod
+    def host(cls, name, **kwargs):
+        """
+        Return the Limiter shared by all users of a host.
+
+        Name identifies the host, such as the socket path or the url, kwargs
+        are passed to the constructor the first time.
+        """
+        with cls.hosts_lock:
+            if name not in cls.hosts:
+                cls.hosts[name] = cls(**kwargs)
+            return cls.hosts[name]
+
+    def available(self, ticket):
+        """Return True if ticket is first in the queue and a slot is free."""
+        return ticket == self.serving and self.in_flight < int(self.limit)
+
+    def acquire(self, deadline=None):
+        """
+        Wait for a slot in FIFO order, return the time it was acquired.
+
+        With a :class:`~lxdapi.deadline.Deadline`, give up the place in the
+        queue and raise :class:`~lxdapi.deadline.DeadlineExceeded` once it
+        expires.
+        """
+        start = time.time()
+
+        with self.condition:
+            ticket = self.tickets
+            self.tickets += 1
+            self.queued += 1
+
+            self.wait(ticket, deadline)
+
+            self.advance()
+            self.queued -= 1
+            self.in_flight += 1
+            self.condition.notify_all()
+
+            acquired = time.time()
+            self.queue_wait += acquired - start
+            self.max_queue_wait = max(self.max_queue_wait, acquired - start)
+
+        return acquired
+
+    def wait(self, ticket, deadline=None):
+        """Wait until ticket is available, abandon it if deadline expires."""
+        while not self.available(ticket):
+            if deadline and deadline.expired:
+                self.abandon(ticket)
+                raise DeadlineExceeded('Limiter slot: deadline of %ss '
+                                       'exceeded' % deadline.seconds)
+
+            self.condition.wait(deadline.remaining() if deadline else None)
+
+    def abandon(self, ticket):
+        """Remove a waiting ticket from the queue."""
+        self.queued -= 1
+
+        if ticket == self.serving:
+            self.advance()
+        else:
+            self.abandoned.add(ticket)
+
+        self.condition.notify_all()
+
+    def advance(self):
+        """Serve the next ticket which wasn't abandoned."""
+        self.serving += 1
+
+        while self.serving in self.abandoned:
+            self.abandoned.remove(self.serving)
+            self.serving += 1
+
+    def release(self, acquired, latency=None, error=False):
+        """
+        Release a slot, adapt the limit with the outcome of the transaction.
+
+        Acquired is the value :meth:`acquire()` returned, latency is the
+        duration of the transaction or None if it should not be used to
+        adapt the limit, such as for long polling.
+        """
+        with self.condition:
+            self.in_flight -= 1
+
+            if error or (latency or 0) > self.latency:
+                self.decrease(acquired)
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def decrease(self, acquired):
+        """Multiply the limit by backoff, unless it was done since acquired."""
+        if acquired > self.decreased_at:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self.decreased_at = time.time()
+
+    def stats(self):
+        """Return a dict with the limit, in_flight, queued and queue waits."""
+        with self.condition:
+            return dict(
+                limit=int(self.limit),
+                in_flight=self.in_flight,
+                queued=self.queued,
+                queue_wait=self.queue_wait,
+                max_queue_wait=self.max_queue_wait,
+            )
+
+
+class Slot(object):
+    """
+    Context manager holding a slot in each of limiters.
+
+    Set :attr:`error` to True in the block to report a daemon failure, such
+    as a 5xx response. IOError and OSError raised in the block, such as
+    connection errors and :class:`~lxdapi.deadline.DeadlineTimeout` for
+    timeouts on the deadline, are reported as errors too. Other exceptions,
+    such as :class:`~lxdapi.deadline.DeadlineExceeded` raised before
+    anything was sent, release the slots without adapting the limits.
+    """
+
+    def __init__(self, limiters, sample=True, deadline=None):
+        """
+        Construct a Slot, sample is False to not use the latency.
+
+        With a :class:`~lxdapi.deadline.Deadline`, waiting for the slots
+        raises :class:`~lxdapi.deadline.DeadlineExceeded` once it expires.
+        """
+        self.limiters = [limiter for limiter in limiters if limiter]
+        self.sample = sample
+        self.deadline = deadline
+        self.error = False
+        self.acquired = []
+
+    def __enter__(self):
+        try:
+            for limiter in self.limiters:
+                self.acquired.append(limiter.acquire(self.deadline))
+        except DeadlineExceeded:
+            self.release(None, False)
+            raise
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type and not issubclass(exc_type, (IOError, OSError)):
+            self.release(None, False)
+        else:
+            latency = time.time() - self.start if self.sample else None
+            self.release(latency, self.error or exc_type is not None)
+
+    def release(self, latency, error):
+        """Release the acquired slots in reverse order."""
+        for limiter, acquired in reversed(list(zip(
+                self.limiters, self.acquired))):
+            limiter.release(acquired, latency, error)
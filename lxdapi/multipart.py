@@ -0,0 +1,143 @@
+"""
+Streaming reader and writer for multipart HTTP bodies.
+
+LXD exports split images as a ``multipart/form-data`` response with a
+``metadata`` and a ``rootfs`` part. :class:`MultipartReader` parses such a
+response chunk by chunk with bounded memory, so parts can be written to
+disk as they are received::
+
+    reader = MultipartReader(boundary(response.headers['Content-Type']))
+    for chunk in response.iter_content(1024 * 1024):
+        for name, data in reader.feed(chunk):
+            files[name].write(data)
+
+Split images are uploaded the same way, :func:`form_data` streams files as
+such a body::
+
+    separator = make_boundary()
+    api.post('images', data=form_data([
+        ('metadata', 'meta.tar.xz'),
+        ('rootfs', 'rootfs.squashfs'),
+    ], separator), headers={
+        'Content-Type': 'multipart/form-data; boundary=%s' % (
+            separator.decode('ascii')),
+    })
+"""
+
+import binascii
+import os
+import re
+
+
+def boundary(content_type):
+    """Return the boundary bytes of a multipart content type."""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise Exception('No boundary in %s' % content_type)
+    return match.group(1).encode('latin-1')
+
+
+def make_boundary():
+    """Return random boundary bytes."""
+    return binascii.hexlify(os.urandom(16))
+
+
+def form_data(parts, boundary, chunk_size=1024 * 1024):
+    """
+    Yield a ``multipart/form-data`` body, reading files in chunks.
+
+    Parts is an iterable of (name, path) tuples, the content of each file
+    is sent as a part with that name.
+    """
+    for name, path in parts:
+        yield b'--' + boundary + b'\r\n' + (
+            'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (
+                name, os.path.basename(path))
+        ).encode('utf-8')
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+        yield b'\r\n'
+
+    yield b'--' + boundary + b'--\r\n'
+
+
+class MultipartReader(object):
+    """
+    Incremental multipart parser yielding (part name, data) tuples.
+
+    It buffers at most a delimiter worth of data in addition to what is
+    being parsed.
+
+    .. attribute:: done
+
+        True once the closing delimiter was read.
+    """
+
+    def __init__(self, boundary):
+        """Construct a MultipartReader for a boundary."""
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = b'\r\n'  # the first delimiter has no leading CRLF
+        self.name = None
+        self.done = False
+
+    def feed(self, data):
+        """Parse data, return the list of (name, data) tuples it completes."""
+        self.buffer += data
+        return [event for event in self.parse() if event[1]]
+
+    def parse(self):
+        """Yield (name, data) tuples until more data is needed."""
+        while not self.done:
+            event = self.body() if self.name else self.headers()
+            if event is None:
+                return
+            yield event
+
+    def body(self):
+        """Return (name, data) of the current part, None if none is ready."""
+        index = self.buffer.find(self.delimiter)
+
+        if index < 0:
+            # keep what could be the beginning of a delimiter
+            index = max(len(self.buffer) - len(self.delimiter), 0)
+            if not index:
+                return None
+            name = self.name
+        else:
+            name, self.name = self.name, None
+
+        data, self.buffer = self.buffer[:index], self.buffer[index:]
+        return name, data
+
+    def headers(self):
+        """Parse the next part headers, return (name, b'') or None."""
+        start = self.buffer.find(self.delimiter)
+
+        if start < 0:
+            self.buffer = self.buffer[-len(self.delimiter):]  # preamble
+            return None
+
+        after = start + len(self.delimiter)
+        if self.buffer[after:after + 2] == b'--':
+            self.done = True
+            return None
+
+        end = self.buffer.find(b'\r\n\r\n', after)
+        if end < 0:
+            return None
+
+        self.name = self.part_name(self.buffer[after:end])
+        self.buffer = self.buffer[end + 4:]
+        return self.name, b''
+
+    @staticmethod
+    def part_name(headers):
+        """Return the name from the Content-Disposition of part headers."""
+        match = re.search(r'name="([^"]*)"', headers.decode('latin-1'))
+        if not match:
+            raise Exception('No part name in %r' % headers)
+        return match.group(1)
@@ -0,0 +1,363 @@
+"""
+Declarative desired state applied with concurrent shortcuts.
+
+A :class:`Plan` is a dependency graph of shortcut calls, named nodes:
+
+- ``image:<path>``: :func:`~lxdapi.shortcuts.image_present`,
+- ``alias:<name>``: :func:`~lxdapi.shortcuts.image_alias_present`, requires
+  the image node,
+- ``container:<name>``: :func:`~lxdapi.shortcuts.container_apply_config`,
+  requires the alias node when the container source is an alias of the
+  plan, or the image node when the source is the fingerprint of an image
+  of the plan,
+- ``status:<name>``: :func:`~lxdapi.shortcuts.container_apply_status`,
+  requires the container node.
+
+Declaring the same image or alias many times adds a single node, so shared
+prerequisites such as an image upload are executed only once. Declarations
+of a node must be identical, conflicting ones raise an exception, such as
+an alias declared for 2 different images.
+:meth:`Plan.apply` runs nodes as soon as their requirements are done, with
+a global concurrency limit, and returns a :class:`PlanReport`.
+
+Example::
+
+    plan = Plan(api)
+    plan.image('busybox.tar.xz', aliases=['busybox'])
+    for name in ('foo', 'bar'):
+        plan.container(dict(
+            name=name,
+            source=dict(type='image', alias='busybox'),
+        ), status='Running')
+    report = plan.apply(processes=8)
+    print(report.changed(), report.critical_path)
+"""
+
+import functools
+import time
+from multiprocessing.pool import ThreadPool
+
+from .shortcuts import (
+    CONCURRENCY,
+    container_apply_config,
+    container_apply_status,
+    container_get,
+    image_alias_present,
+    image_get_fingerprint,
+    image_get_fingerprints,
+    image_present,
+)
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue  # noqa
+
+
+def declaration(function):
+    """Return a comparable value for a function or functools.partial."""
+    if isinstance(function, functools.partial):
+        return function.func, function.args, function.keywords
+    return function
+
+
+class PlanReport(dict):
+    """
+    Map node keys to True if the node changed something, False otherwise.
+
+    .. attribute:: timings
+
+        Dict of node keys to the seconds each node took.
+
+    .. attribute:: critical_path
+
+        List of (key, seconds) tuples, the chain of requirements which
+        finished last, from the first node to the last one.
+
+    .. attribute:: total
+
+        Seconds spent applying the whole plan.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PlanReport, self).__init__(*args, **kwargs)
+        self.timings = {}
+        self.critical_path = []
+        self.total = 0
+
+    def changed(self):
+        """Return the sorted list of keys of nodes which changed."""
+        return sorted(key for key, changed in self.items() if changed)
+
+
+class Node(object):
+    """
+    A function call in a :class:`Plan`, run once its requirements are done.
+
+    .. attribute:: changed
+
+        Return value of the function, None until it ran.
+    """
+
+    def __init__(self, key, function, requires=None):
+        """Construct a Node with a key, a function and requirement keys."""
+        self.key = key
+        self.function = function
+        self.requires = set(requires or [])
+        self.declaration = (declaration(function), frozenset(self.requires))
+        self.changed = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        """Seconds the function took to run."""
+        return self.end - self.start
+
+    def run(self):
+        """Call the function, return (node, exception or None)."""
+        self.start = time.time()
+
+        try:
+            self.changed = self.function()
+        except Exception as e:
+            return self, e
+        finally:
+            self.end = time.time()
+
+        return self, None
+
+
+class Plan(object):
+    """
+    Dependency graph of images, aliases and containers for an API.
+
+    .. attribute:: nodes
+
+        Dict of :class:`Node` by key.
+    """
+
+    def __init__(self, api):
+        """Construct an empty Plan for an :class:`~lxdapi.api.API`."""
+        self.api = api
+        self.nodes = {}
+        self.fingerprints = {}
+        self.images = {}
+        self.sources = {}
+        self.deadline = None
+
+    def add(self, key, function, requires=None):
+        """
+        Add a :class:`Node` unless there's an identical one already.
+
+        Raise an exception if there's a node with that key but another
+        function, arguments or requirements.
+        """
+        declared = Node(key, function, requires)
+        node = self.nodes.setdefault(key, declared)
+
+        if node.declaration != declared.declaration:
+            raise Exception('Conflicting declarations of %s' % key)
+
+        return node
+
+    def image(self, path, fingerprint=None, aliases=None):
+        """
+        Declare an image, return its node.
+
+        The fingerprint is computed by the node if not given, aliases is a
+        list of alias names to point to the image.
+        """
+        node = self.add(
+            'image:%s' % path,
+            functools.partial(self.image_present, path, fingerprint),
+        )
+        self.images[path] = fingerprint
+
+        for alias in aliases or []:
+            self.add(
+                'alias:%s' % alias,
+                functools.partial(self.image_alias_present, alias, path),
+                [node.key],
+            )
+
+        return node
+
+    def image_present(self, path, fingerprint):
+        """Compute the fingerprint if necessary, and upload the image."""
+        fingerprint = fingerprint or self.images.get(path)
+        fingerprint = fingerprint or image_get_fingerprint(path)
+        self.fingerprints[path] = fingerprint
+        return image_present(self.api, path, fingerprint, self.deadline)
+
+    def image_alias_present(self, alias, path):
+        """Point an alias to the fingerprint of an image of the plan."""
+        return image_alias_present(
+            self.api, alias, self.fingerprints[path], deadline=self.deadline)
+
+    def container(self, config, status=None, requires=None):
+        """
+        Declare a container, return its last node.
+
+        Config is the dict for :func:`~lxdapi.shortcuts.container_apply_config`,
+        if its source is an alias declared in the plan, the container node
+        requires the alias node, if its source is the fingerprint of an
+        image declared in the plan, it requires the image node. If status is given a status node is added.
+        Requires is an optional list of extra requirement keys.
+        """
+        name = config['name']
+        node = self.add(
+            'container:%s' % name,
+            functools.partial(self.container_apply_config, name, config),
+            requires,
+        )
+        self.sources[node.key] = config.get('source') or {}
+
+        if status:
+            node = self.add(
+                'status:%s' % name,
+                functools.partial(self.container_apply_status, name, status),
+                [node.key],
+            )
+
+        return node
+
+    def container_apply_config(self, name, config):
+        """Create the container if it doesn't exist."""
+        return container_apply_config(
+            self.api,
+            container_get(self.api, name, self.deadline),
+            config,
+            self.deadline,
+        )
+
+    def container_apply_status(self, name, status):
+        """Apply a status to the container."""
+        return container_apply_status(
+            self.api,
+            container_get(self.api, name, self.deadline),
+            status,
+            self.deadline,
+        )
+
+    def apply(self, processes=None, deadline=None):
+        """
+        Run all nodes, return a :class:`PlanReport`.
+
+        Up to processes nodes, :data:`~lxdapi.shortcuts.CONCURRENCY` by
+        default, run at the same time, each as soon as its requirements are
+        done. If a node raises an exception, no other node is started, and
+        the exception is raised once the running nodes are done.
+
+        Deadline is a :class:`~lxdapi.deadline.Deadline` shared by all
+        nodes, the first node to exceed it raises
+        :class:`~lxdapi.deadline.DeadlineExceeded`.
+        """
+        self.deadline = deadline
+        self.resolve()
+        start = time.time()
+        pool = ThreadPool(processes or CONCURRENCY)
+
+        try:
+            self.execute(pool)
+        finally:
+            pool.terminate()
+
+        return self.report(time.time() - start)
+
+    def resolve(self):
+        """Make containers require their source node, check requirements."""
+        for key, source in self.sources.items():
+            required = self.source_node(source)
+            if required:
+                self.nodes[key].requires.add(required)
+
+        for node in self.nodes.values():
+            if node.requires - set(self.nodes):
+                raise Exception('%s requires unknown nodes: %s' % (
+                    node.key, sorted(node.requires - set(self.nodes))))
+
+    def source_node(self, source):
+        """Return the key of the alias or image node of a source or None."""
+        if 'alias:%s' % source.get('alias') in self.nodes:
+            return 'alias:%s' % source['alias']
+
+        fingerprint = source.get('fingerprint')
+        if not fingerprint:
+            return None
+
+        for path, known in self.image_fingerprints().items():
+            if known.startswith(fingerprint):
+                return 'image:%s' % path
+
+    def image_fingerprints(self):
+        """Return fingerprints by image path, computing missing ones."""
+        missing = [path for path, known in self.images.items() if not known]
+        if missing:
+            self.images.update(image_get_fingerprints(missing))
+        return self.images
+
+    def execute(self, pool):
+        """Run the nodes in a pool in dependency order."""
+        finished = queue.Queue()
+        waiting = dict((k, set(n.requires)) for k, n in self.nodes.items())
+        running = self.submit(pool, finished, waiting)
+
+        while running:
+            node, error = finished.get()
+            running -= 1
+
+            if error:
+                return self.drain(finished, running, error)
+
+            for requires in waiting.values():
+                requires.discard(node.key)
+            running += self.submit(pool, finished, waiting)
+
+        if waiting:
+            raise Exception('Dependency cycle in: %s' % sorted(waiting))
+
+    def submit(self, pool, finished, waiting):
+        """Start the nodes which have no requirement left, return how many."""
+        ready = [key for key, requires in waiting.items() if not requires]
+
+        for key in ready:
+            del waiting[key]
+            pool.apply_async(self.nodes[key].run, callback=finished.put)
+
+        return len(ready)
+
+    @staticmethod
+    def drain(finished, running, error):
+        """Wait for the running nodes, then raise error."""
+        for i in range(running):
+            finished.get()
+
+        raise error
+
+    def report(self, total):
+        """Return the :class:`PlanReport` of an applied plan."""
+        report = PlanReport(
+            (key, node.changed) for key, node in self.nodes.items())
+        report.timings = dict(
+            (key, node.duration) for key, node in self.nodes.items())
+        report.critical_path = self.critical_path()
+        report.total = total
+        return report
+
+    def critical_path(self):
+        """Return the (key, seconds) chain of requirements which ended last."""
+        if not self.nodes:
+            return []
+
+        node = max(self.nodes.values(), key=lambda n: n.end)
+        path = [node]
+
+        while node.requires:
+            node = max(
+                (self.nodes[key] for key in node.requires),
+                key=lambda n: n.end,
+            )
+            path.insert(0, node)
+
+        return [(node.key, node.duration) for node in path]
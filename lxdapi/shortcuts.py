@@ -6,21 +6,107 @@ Functions here have the following similarities:
 - take a :class:`~lxdapi.api.API` as first argument,
 - return True if something has changed, False otherwise,
 - except ``_get()`` functions such as ``container_get()`` which return
-  :class:`~lxdapi.api.APIResult` for an :meth:`lxdapi.api.API.get` or False.
+  :class:`~lxdapi.api.APIResult` for an :meth:`lxdapi.api.API.get` or False,
+- take an optional :class:`~lxdapi.deadline.Deadline` as ``deadline``
+  keyword argument, shared by all their requests and waits.
 """
 
+import functools
 import hashlib
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from .api import APINotFoundException
+from .api import APIException, APINotFoundException
+from .deadline import DeadlineExceeded
+from .execution import Execution, Multiplexer
+from .multipart import MultipartReader, boundary, form_data, make_boundary
 
 
-def container_absent(api, container):
+CHUNK_SIZE = 1024 * 1024
+"""Default number of bytes read at once when streaming files."""
+
+CONCURRENCY = 8
+"""Default number of threads used by the bulk shortcuts."""
+
+STOP_SHARE = 0.5
+"""Share of the remaining deadline given to a container to stop gracefully."""
+
+
+class TeardownReport(dict):
+    """
+    Map container names to the seconds it took to tear each one down.
+
+    Returned by :func:`containers_absent`, it only contains the containers
+    which were actually removed, so it evaluates to False if nothing changed.
+
+    .. attribute:: total
+
+        Seconds spent tearing down the whole batch.
+    """
+
+    total = 0
+
+
+def _container_stop(api, name, timeout, force, deadline=None):
+    """
+    Stop a container, give it timeout seconds to shut down gracefully.
+
+    If force is True and the graceful stop fails or is still running when
+    its wait returns, kill the container.
+    """
+    url = 'containers/%s/state' % name
+    timeout, wait = _container_stop_timeouts(api, timeout, force, deadline)
+
+    try:
+        api.put(
+            url,
+            json=dict(action='stop', timeout=timeout),
+            deadline=deadline,
+        ).wait(wait)
+    except (APIException, DeadlineExceeded):
+        if not force:
+            raise
+        api.put(
+            url,
+            json=dict(action='stop', force=True),
+            deadline=deadline,
+        ).wait()
+
+
+def _container_stop_timeouts(api, timeout, force, deadline=None):
+    """
+    Return the grace period and wait timeout of a graceful stop.
+
+    With a deadline, the grace period is capped to :data:`STOP_SHARE` of the
+    remaining time, the rest is left to kill and delete the container.
+    """
+    timeout = api.timeout(timeout)
+
+    if not deadline:
+        return timeout, timeout + api.default_timeout
+
+    share = int(deadline.remaining() * STOP_SHARE)
+    timeout = min(timeout, share if force else max(share, 1))
+    return timeout, timeout + 1
+
+
+def container_absent(api, container, timeout=None, force=False,
+                     deadline=None):
     """
     Ensure a container is absent.
 
     Container is an :class:`~lxdapi.api.APIResult` for the container, to be
     able to compare the configuration with.
 
+    Timeout is the grace period in seconds given to a running container to
+    stop, it defaults to :attr:`~lxdapi.api.API.default_timeout`. If force
+    is True, the container is killed when it fails to stop within the grace
+    period; with a timeout of 0 it is killed right away. With a deadline,
+    the grace period is capped to :data:`STOP_SHARE` of the remaining time
+    so that there's time left to kill and delete the container.
+
     It is expected that the user manages the HTTP transactions, here's an
     example usage::
 
@@ -29,20 +115,66 @@ def container_absent(api, container):
     if not container:
         return False
 
+    name = container.metadata['name']
+
     if container.metadata['status'] == 'Running':
-        api.put(
-            'containers/%s/state' % container.metadata['name'],
-            json=dict(
-                action='stop',
-                timeout=api.default_timeout,
-            )
-        ).wait()
+        _container_stop(api, name, timeout, force, deadline)
 
-    api.delete('containers/%s' % container.metadata['name']).wait()
+    api.delete('containers/%s' % name, deadline=deadline).wait()
     return True
 
 
-def container_apply_config(api, container, config):
+def _container_teardown(api, name, **kwargs):
+    """Return name and teardown time, time is None if nothing changed."""
+    start = time.time()
+
+    container = container_get(api, name, deadline=kwargs.get('deadline'))
+
+    if not container_absent(api, container, **kwargs):
+        return name, None
+
+    return name, time.time() - start
+
+
+def containers_absent(api, names, timeout=None, force=False, processes=None,
+                      deadline=None):
+    """
+    Ensure many containers are absent, tearing them down concurrently.
+
+    Names is an iterable of container names. Up to processes containers,
+    :data:`CONCURRENCY` by default, are fetched, stopped and deleted at the
+    same time, each container being deleted as soon as it has stopped.
+    Timeout, force and deadline are passed to :func:`container_absent`, so
+    a deadline bounds the whole batch.
+
+    Return a :class:`TeardownReport`, which is empty if nothing changed::
+
+        report = containers_absent(api, ['foo', 'bar'], timeout=5, force=True)
+        print(report.total, report.get('foo'))
+    """
+    report = TeardownReport()
+    start = time.time()
+    teardown = functools.partial(
+        _container_teardown,
+        api,
+        timeout=timeout,
+        force=force,
+        deadline=deadline,
+    )
+    pool = ThreadPool(processes or CONCURRENCY)
+
+    try:
+        for name, elapsed in pool.imap_unordered(teardown, names):
+            if elapsed is not None:
+                report[name] = elapsed
+    finally:
+        pool.terminate()
+
+    report.total = time.time() - start
+    return report
+
+
+def container_apply_config(api, container, config, deadline=None):
     """
     Apply a configuration on a container.
 
@@ -56,19 +188,20 @@ def container_apply_config(api, container, config):
         container_apply_config(api, container_get('yourcontainer'))
     """
     if not container:
-        api.post('containers', json=config).wait()
+        api.post('containers', json=config, deadline=deadline).wait()
         return True
 
     return False
 
 
-def container_apply_status(api, container, status):
+def container_apply_status(api, container, status, deadline=None):
     """Apply an LXD status to a container.
 
     Container is an:class:`lxdapi.api.APIResult`for the container, to be able
     to compare the status with.
 
-    Status is a string, choices are: Running, Stopped, Frozen.
+    Status is a string, choices are: Running, Stopped, Frozen. The action
+    timeout is capped to the deadline if any.
 
     Example usage::
 
@@ -94,74 +227,677 @@ def container_apply_status(api, container, status):
         'containers/%s/state' % container.metadata['name'],
         json=dict(
             action=action,
-            timeout=api.default_timeout,
-        )
+            timeout=api.timeout(deadline=deadline),
+        ),
+        deadline=deadline,
     ).wait()
 
     return True
 
 
-def container_get(api, name):
+def container_exec(api, container, command, **kwargs):
+    """
+    Run a command in a container, return its :class:`~lxdapi.execution.Execution`.
+
+    Container is the container name, command the list of arguments. Extra
+    kwargs are passed to :func:`containers_exec`: ``stdin`` bytes,
+    ``environment`` dict, ``on_stdout`` and ``on_stderr`` callbacks and
+    ``deadline``.
+
+    Example usage::
+
+        execution = container_exec(api, 'yourcontainer', ['hostname'])
+        print(execution.return_code, execution.stdout, execution.stderr)
+    """
+    return containers_exec(api, [(container, command)], **kwargs)[0]
+
+
+def containers_exec(api, commands, processes=None, deadline=None, **kwargs):
+    """
+    Run commands in containers concurrently, return their executions.
+
+    Commands is a list of (container, command) tuples. Up to processes,
+    :data:`CONCURRENCY` by default, commands are started concurrently, then
+    all their websockets are read in the calling thread by a
+    :class:`~lxdapi.execution.Multiplexer`. Extra kwargs are passed to
+    every :class:`~lxdapi.execution.Execution`. If deadline expires before
+    all commands finished, the remaining ones are detached and
+    :class:`~lxdapi.deadline.DeadlineExceeded` is raised.
+
+    Return the list of :class:`~lxdapi.execution.Execution` in the order of
+    commands, once they have all finished. If a command fails to start, the
+    websockets of the others are closed and the exception is raised.
+    """
+    start = functools.partial(
+        _container_exec_start, api, deadline=deadline, **kwargs)
+    pool = ThreadPool(processes or CONCURRENCY)
+    multiplexer = Multiplexer()
+
+    try:
+        executions = _container_exec_started([
+            pool.apply_async(start, (command,)) for command in commands
+        ])
+    finally:
+        pool.terminate()
+
+    for execution in executions:
+        multiplexer.add(execution)
+
+    list(multiplexer.run(deadline))
+    return executions
+
+
+def _container_exec_start(api, command, **kwargs):
+    """Return an :class:`~lxdapi.execution.Execution` for a tuple."""
+    return Execution(api, *command, **kwargs)
+
+
+def _container_exec_started(results):
+    """Return the started executions, shut them down if any failed."""
+    outcomes = [_async_outcome(result) for result in results]
+    executions = [o for o, failed in outcomes if not failed]
+    errors = [o for o, failed in outcomes if failed]
+
+    if errors:
+        for execution in executions:
+            execution.shutdown()
+        raise errors[0]
+
+    return executions
+
+
+def _async_outcome(result):
+    """Return (value, False) for an async result, or (exception, True)."""
+    try:
+        return result.get(), False
+    except Exception as e:
+        return e, True
+
+
+def container_get(api, name, deadline=None):
     """Return the:class:`lxdapi.api.APIResult`for a container or False."""
     try:
-        return api.get('containers/%s' % name)
+        return api.get('containers/%s' % name, deadline=deadline)
     except APINotFoundException:
         return False
 
 
-def image_absent(api, fingerprint):
+def image_absent(api, fingerprint, deadline=None):
     """
     Return False if the image is absent, otherwise delete it and return True.
     """
-    if not image_get(api, fingerprint):
+    if not image_get(api, fingerprint, deadline):
         return False
 
-    api.delete('images/%s' % fingerprint).wait()
+    api.delete('images/%s' % fingerprint, deadline=deadline).wait()
     return True
 
 
-def image_get_fingerprint(path):
-    """Return the fingerprint for an image."""
-    with open(path, 'rb') as f:
-        return hashlib.sha256(f.read()).hexdigest()
+def file_get(api, container, path, deadline=None):
+    """
+    Return the :class:`~lxdapi.api.APIResult` for a container file or False.
+
+    The response is streamed: for a regular file, read the content from
+    ``result.iter_content()``, or close ``result.response``.
+    """
+    try:
+        return api.get(
+            'containers/%s/files' % container,
+            params=dict(path=path),
+            stream=True,
+            deadline=deadline,
+        )
+    except APINotFoundException:
+        return False
+
+
+def _file_hash(path, chunk_size=CHUNK_SIZE):
+    """
+    Return the sha256 hexdigest of a local file, reading it in chunks.
+
+    Path may also be a tuple of paths to hash the concatenation of files.
+    """
+    paths = path if isinstance(path, tuple) else (path,)
+    return _stream_hash(_file_chunks(paths, chunk_size))
+
+
+def _file_chunks(paths, chunk_size):
+    """Yield the chunks of each file in paths."""
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+def _stream_hash(chunks):
+    """Return the sha256 hexdigest of an iterable of chunks."""
+    sha256 = hashlib.sha256()
+
+    for chunk in chunks:
+        sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _file_headers(result):
+    """Return the (type, mode, uid, gid) tuple of a file_get() result."""
+    headers = result.response.headers
+    return (
+        headers.get('X-LXD-type', 'file'),
+        int(headers.get('X-LXD-mode', '0'), 8),
+        int(headers.get('X-LXD-uid', '-1')),
+        int(headers.get('X-LXD-gid', '-1')),
+    )
+
+
+def _file_matches(result, source, attributes, chunk_size):
+    """Return True if the remote file has the source content and attributes."""
+    if _file_headers(result) != ('file',) + attributes:
+        return False
+
+    length = result.response.headers.get('Content-Length')
+    if length is not None and int(length) != os.path.getsize(source):
+        return False
+
+    remote = _stream_hash(result.iter_content(chunk_size))
+    return remote == _file_hash(source, chunk_size)
+
+
+def _file_push(api, container, path, source, attributes, sendfile,
+               deadline=None):
+    """Upload a local file, streaming it instead of reading it in memory."""
+    url = 'containers/%s/files' % container
+    params = dict(path=path)
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'X-LXD-type': 'file',
+        'X-LXD-mode': '%04o' % attributes[0],
+        'X-LXD-uid': str(attributes[1]),
+        'X-LXD-gid': str(attributes[2]),
+    }
+
+    with open(source, 'rb') as f:
+        if sendfile:
+            return api.sendfile('POST', url, f, headers, params, deadline)
+        return api.post(
+            url, params=params, data=f, headers=headers, deadline=deadline)
+
+
+def file_push_present(api, container, path, source, mode=None, uid=0,
+                      gid=0, sendfile=False, chunk_size=CHUNK_SIZE,
+                      deadline=None):
+    """
+    Ensure a container file has the content of a local file.
+
+    Container is the container name, path is the absolute path of the file
+    in the container, source is the path to the local file. Mode defaults
+    to the mode of the local file.
+
+    Nothing is uploaded if the remote file already has the same sha256,
+    mode, uid and gid; the remote content is streamed in chunk_size chunks
+    to compute it. If sendfile is True, the upload uses
+    :meth:`~lxdapi.api.API.sendfile()`, otherwise it's streamed by requests.
+
+    Example usage::
+
+        file_push_present(api, 'yourcontainer', '/etc/app.conf', 'app.conf')
+    """
+    if mode is None:
+        mode = os.stat(source).st_mode & 0o777
+    attributes = (mode, uid, gid)
+
+    result = file_get(api, container, path, deadline)
+    if result:
+        try:
+            if _file_matches(result, source, attributes, chunk_size):
+                return False
+        finally:
+            result.response.close()
+
+    _file_push(api, container, path, source, attributes, sendfile, deadline)
+    return True
+
+
+def _directory_present(api, container, path, mode, uid=0, gid=0,
+                       deadline=None):
+    """
+    Ensure a directory exists in a container with a mode, uid and gid.
+
+    Return True if the directory was created or its attributes changed.
+    """
+    result = file_get(api, container, path, deadline)
+    if result:
+        result.response.close()
+        if _file_headers(result) == ('directory', mode, uid, gid):
+            return False
+
+    api.post(
+        'containers/%s/files' % container,
+        params=dict(path=path),
+        headers={
+            'X-LXD-type': 'directory',
+            'X-LXD-mode': '%04o' % mode,
+            'X-LXD-uid': str(uid),
+            'X-LXD-gid': str(gid),
+        },
+        deadline=deadline,
+    )
+    return True
+
+
+def _tree(source, target):
+    """Yield (is_directory, local, remote) paths for a local tree."""
+    for root, directories, files in os.walk(source):
+        remote = os.path.join(target, os.path.relpath(root, source))
+        yield True, root, os.path.normpath(remote)
+        for name in sorted(files):
+            yield False, os.path.join(root, name), os.path.join(
+                os.path.normpath(remote), name)
 
 
-def image_get(api, fingerprint):
+def files_push_present(api, container, target, source, uid=0, gid=0,
+                       processes=None, **kwargs):
+    """
+    Ensure a container directory has the content of a local directory.
+
+    Directories are created first, one at a time and parents first, then up
+    to processes, :data:`CONCURRENCY` by default, files are pushed
+    concurrently with :func:`file_push_present`, extra kwargs are passed
+    to it, including ``deadline``. Modes are copied from the local files and
+    directories.
+
+    Return True if any directory or file was changed.
+
+    Example usage::
+
+        files_push_present(api, 'yourcontainer', '/srv/app', 'build/app')
+    """
+    files = []
+    changed = False
+
+    for is_directory, local, remote in _tree(source, target):
+        if is_directory:
+            mode = os.stat(local).st_mode & 0o777
+            changed |= _directory_present(
+                api, container, remote, mode, uid, gid,
+                kwargs.get('deadline'))
+        else:
+            files.append((remote, local))
+
+    push = functools.partial(
+        _file_push_present, api, container, uid=uid, gid=gid, **kwargs)
+    pool = ThreadPool(processes or CONCURRENCY)
+
+    try:
+        return any(pool.map(push, files)) or changed
+    finally:
+        pool.terminate()
+
+
+def _file_push_present(api, container, paths, **kwargs):
+    """Call :func:`file_push_present` with a (path, source) tuple."""
+    return file_push_present(api, container, *paths, **kwargs)
+
+
+def file_pull(api, container, path, target, chunk_size=CHUNK_SIZE,
+              deadline=None):
+    """
+    Ensure a local file has the content of a container file.
+
+    The content is streamed in chunk_size chunks to ``target + '.part'``,
+    hashing it on the way, and is then moved to target unless target
+    already had the same content. The mode of the container file is applied
+    to target, even if it already had the same content.
+
+    Return True if the content or mode of target was changed, raise
+    :class:`~lxdapi.api.APINotFoundException` if the container file does
+    not exist.
+
+    Example usage::
+
+        file_pull(api, 'yourcontainer', '/var/log/app.log', 'app.log')
+    """
+    result = api.get(
+        'containers/%s/files' % container,
+        params=dict(path=path),
+        stream=True,
+        deadline=deadline,
+    )
+    partial = target + '.part'
+
+    with open(partial, 'wb') as f:
+        fingerprint = _stream_hash(
+            _file_write(f, result.iter_content(chunk_size)))
+
+    mode = None
+    if 'X-LXD-mode' in result.response.headers:
+        mode = _file_headers(result)[1]
+
+    if os.path.exists(target) and _file_hash(target) == fingerprint:
+        os.remove(partial)
+        return _file_chmod(target, mode)
+
+    _file_chmod(partial, mode)
+    os.rename(partial, target)
+    return True
+
+
+def _file_chmod(path, mode):
+    """Apply mode to a local file unless None, return True if changed."""
+    if mode is None or os.stat(path).st_mode & 0o777 == mode:
+        return False
+
+    os.chmod(path, mode)
+    return True
+
+
+def _file_write(f, chunks):
+    """Write chunks to f, yielding them on the way."""
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+
+def image_get_fingerprint(path, chunk_size=CHUNK_SIZE):
+    """
+    Return the fingerprint for an image.
+
+    Path is the path to a unified image tarball, or a (metadata, rootfs)
+    tuple of paths for a split image, whose fingerprint covers both files.
+    """
+    return _file_hash(path, chunk_size)
+
+
+def _image_fingerprint(args):
+    """Return (path, fingerprint) for a (path, chunk_size) tuple."""
+    return args[0], image_get_fingerprint(*args)
+
+
+def image_get_fingerprints(paths, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Return a dict of fingerprints by path, hashing images in parallel.
+
+    Paths is an iterable of paths accepted by :func:`image_get_fingerprint`,
+    including (metadata, rootfs) tuples for split images. Files are hashed
+    in chunks by a pool of processes, the number of cpus by default, so
+    that hashing isn't bound to a single core.
+
+    Example usage::
+
+        fingerprints = image_get_fingerprints(glob.glob('images/*.tar.xz'))
+    """
+    args = [(path, chunk_size) for path in paths]
+    pool = Pool(processes)
+
+    try:
+        return dict(pool.imap_unordered(_image_fingerprint, args))
+    finally:
+        pool.terminate()
+
+
+def image_get(api, fingerprint, deadline=None):
     """Return the :class:`APIResult` for a fingerprint or False."""
     try:
-        return api.get('images/%s' % fingerprint)
+        return api.get('images/%s' % fingerprint, deadline=deadline)
     except APINotFoundException:
         return False
 
 
-def image_present(api, path, fingerprint=None):
-    """Ensure an image is present."""
+def image_present(api, path, fingerprint=None, deadline=None):
+    """
+    Ensure an image is present.
+
+    Path is the path to a unified image tarball, or a (metadata, rootfs)
+    tuple of paths for a split image, which is streamed as a multipart
+    upload, like for :func:`image_get_fingerprint`.
+    """
     fingerprint = fingerprint or image_get_fingerprint(path)
 
-    if image_get(api, fingerprint):
+    if image_get(api, fingerprint, deadline):
         return False  # nuthin to do
 
+    if isinstance(path, tuple):
+        _image_split_upload(api, path, deadline)
+        return True
+
     with open(path, 'rb') as f:
         headers = {
             'X-LXD-Public': '1',
         }
-        api.post('images', data=f.read(), headers=headers).wait()
+        api.post(
+            'images', data=f, headers=headers, deadline=deadline
+        ).wait()
+
+    return True
+
+
+def _image_split_upload(api, paths, deadline=None):
+    """Upload a split image from a (metadata, rootfs) tuple of paths."""
+    separator = make_boundary()
+    headers = {
+        'X-LXD-Public': '1',
+        'Content-Type': 'multipart/form-data; boundary=%s' % (
+            separator.decode('ascii')),
+    }
+
+    api.post(
+        'images',
+        data=form_data(zip(('metadata', 'rootfs'), paths), separator),
+        headers=headers,
+        deadline=deadline,
+    ).wait()
+
+
+def image_build_present(api, builder, fingerprint=None, deadline=None):
+    """
+    Ensure an image built by an :class:`~lxdapi.image.ImageBuilder` is present.
+
+    The tarball is streamed into the upload as it is built and compressed,
+    without a temporary file. Return True if the image was created, False
+    if it was already present; ``builder.fingerprint`` is set once built.
+
+    Unlike :func:`image_present`, this is not a cheap no-op: the fingerprint
+    is only known once the tarball is built, so without a fingerprint the
+    image is always built and uploaded, and only then found to exist. Pass
+    the fingerprint of a previous build to skip the build if LXD already
+    has it.
+
+    Example usage::
+
+        builder = ImageBuilder('build/busybox', codec='xz')
+        image_build_present(api, builder)
+        image_alias_present(api, 'busybox', builder.fingerprint)
+    """
+    if fingerprint and image_get(api, fingerprint, deadline):
+        return False
+
+    try:
+        _image_build_upload(api, builder, deadline)
+    except APIException:
+        if builder.fingerprint and image_get(
+                api, builder.fingerprint, deadline):
+            return False
+        raise
+
+    return True
+
+
+def _image_build_upload(api, builder, deadline=None):
+    """Stream the tarball of builder into an image upload, check it."""
+    headers = {
+        'X-LXD-Public': '1',
+    }
+
+    result = api.post(
+        'images', data=iter(builder), headers=headers, deadline=deadline
+    ).wait()
+
+    uploaded = result.metadata['metadata']['fingerprint']
+    if uploaded != builder.fingerprint:
+        raise Exception('Uploaded %s but LXD got %s' % (
+            builder.fingerprint, uploaded))
+
+
+def _image_files(fingerprint, paths, chunk_size):
+    """Return the split or unified paths with the image content, or None."""
+    for candidate in (paths, paths[:1]):
+        if not all(os.path.exists(p) for p in candidate):
+            continue
+        if _file_hash(candidate, chunk_size) == fingerprint:
+            return candidate
+
+    return None
+
+
+def _image_export_complete(fingerprint, paths, chunk_size):
+    """Move ``.part`` files in place if they have the image content."""
+    partials = _image_files(
+        fingerprint, tuple(p + '.part' for p in paths), chunk_size)
+
+    for partial in partials or ():
+        os.rename(partial, partial[:-len('.part')])
+
+    return bool(partials)
+
+
+def _image_export_verify(sha256, fingerprint, partials):
+    """Move partials in place if sha256 matches, otherwise delete them."""
+    if sha256.hexdigest() != fingerprint:
+        for partial in partials:
+            os.remove(partial)
+        raise Exception('Export of image %s has fingerprint %s' % (
+            fingerprint, sha256.hexdigest()))
+
+    for partial in partials:
+        os.rename(partial, partial[:-len('.part')])
+
+
+def _image_export_unified(result, fingerprint, path, offset, chunk_size):
+    """Write a unified image export, resuming if the server sent a range."""
+    partial = path + '.part'
+    response = result.response
+    sha256 = hashlib.sha256()
+    mode = 'wb'
+
+    resumed = response.status_code == 206 and response.headers.get(
+        'Content-Range', '').startswith('bytes %s-' % offset)
+    if resumed:
+        mode = 'ab'
+        for chunk in _file_chunks((partial,), chunk_size):
+            sha256.update(chunk)
+
+    with open(partial, mode) as f:
+        for chunk in result.iter_content(chunk_size):
+            sha256.update(chunk)
+            f.write(chunk)
+
+    _image_export_verify(sha256, fingerprint, [partial])
+
+
+def _image_export_split(result, fingerprint, paths, chunk_size):
+    """Write the metadata and rootfs parts of a split image export."""
+    reader = MultipartReader(boundary(result.response.headers['Content-Type']))
+    sha256 = hashlib.sha256()
+    files = {}
+
+    try:
+        for chunk in result.iter_content(chunk_size):
+            for name, data in reader.feed(chunk):
+                if name not in files:
+                    files[name] = open(paths[name] + '.part', 'wb')
+                sha256.update(data)
+                files[name].write(data)
+    finally:
+        for f in files.values():
+            f.close()
+
+    _image_export_verify(
+        sha256, fingerprint, [paths[name] + '.part' for name in files])
+
+
+def _image_export_get(api, fingerprint, offset, deadline=None):
+    """Request the export from offset, from 0 if it's not satisfiable."""
+    url = 'images/%s/export' % fingerprint
+
+    try:
+        return api.get(
+            url,
+            stream=True,
+            headers={'Range': 'bytes=%s-' % offset} if offset else {},
+            deadline=deadline,
+        )
+    except APIException as e:
+        e.result.response.close()
+        if not offset or e.result.response.status_code != 416:
+            raise
+
+    return api.get(url, stream=True, deadline=deadline)
+
+
+def _image_export_download(api, fingerprint, paths, chunk_size,
+                           deadline=None):
+    """Download the export to ``.part`` files and move them in place."""
+    partial = paths[0] + '.part'
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    result = _image_export_get(api, fingerprint, offset, deadline)
+
+    try:
+        if result.response.headers.get('Content-Type', '').startswith(
+                'multipart/'):
+            _image_export_split(result, fingerprint, dict(
+                metadata=paths[0], rootfs=paths[1]), chunk_size)
+        else:
+            _image_export_unified(
+                result, fingerprint, paths[0], offset, chunk_size)
+    finally:
+        result.response.close()
+
+
+def image_export(api, fingerprint, path, rootfs_path=None,
+                 chunk_size=CHUNK_SIZE, deadline=None):
+    """
+    Ensure local files have the content of an image, return True if changed.
+
+    The export is streamed in chunk_size chunks to ``path + '.part'`` and
+    its sha256 is computed while writing, the file is moved to path only if
+    it matches the fingerprint. Nothing is downloaded if path already
+    matches the fingerprint.
+
+    If a ``.part`` file is left over by an interrupted download, it is moved
+    in place if it already matches the fingerprint, otherwise it is resumed
+    with an HTTP Range request. The download restarts from the beginning if
+    the server doesn't resume it, including when it can't satisfy the range.
+
+    For split images, the metadata is written to path and the rootfs to
+    rootfs_path, ``path + '.rootfs'`` by default.
+
+    Example usage::
+
+        image_export(api, fingerprint, 'images/%s.tar.xz' % fingerprint)
+    """
+    paths = (path, rootfs_path or path + '.rootfs')
+
+    if _image_files(fingerprint, paths, chunk_size):
+        return False
+
+    if not _image_export_complete(fingerprint, paths, chunk_size):
+        _image_export_download(api, fingerprint, paths, chunk_size, deadline)
 
     return True
 
 
-def image_alias_present(api, name, target, description=None):
+def image_alias_present(api, name, target, description=None, deadline=None):
     """Ensure an image has an alias."""
     try:
-        result = api.get('images/aliases/%s' % name)
+        result = api.get('images/aliases/%s' % name, deadline=deadline)
     except APINotFoundException:
         pass
     else:
         if result.metadata['target'] == target:
             return False
-        api.delete('images/aliases/%s' % name)
+        api.delete('images/aliases/%s' % name, deadline=deadline)
 
-    api.post('images/aliases', json=dict(
+    api.post('images/aliases', deadline=deadline, json=dict(
         name=name,
         target=target,
         description=description or '',
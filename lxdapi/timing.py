@@ -0,0 +1,183 @@
+"""
+Timing breakdown of async operations.
+
+:class:`~lxdapi.api.API` attaches an :class:`OperationSpan` to the
+:class:`~lxdapi.api.APIResult` of requests which created an operation, as
+``result.span``, and completes it when :meth:`~lxdapi.api.APIResult.wait`
+returns. The span combines local timestamps with the ``created_at`` and
+``updated_at`` timestamps of the operation metadata, to split its duration
+in phases:
+
+- ``submit``: from sending the request to the operation creation,
+- ``queued``: from the operation creation to it running,
+- ``running``: from the operation running to its last update,
+- ``wait``: from the last update to the wait call returning,
+- ``total``: from sending the request to the wait call returning.
+
+Daemon timestamps are compared with local ones, which is accurate with a
+local socket and as accurate as clock synchronization otherwise.
+
+Set :attr:`~lxdapi.api.API.spans` to a :class:`SpanAggregator` to collect
+completed spans and report percentiles per operation type::
+
+    api.spans = SpanAggregator()
+    container_apply_status(api, container_get(api, 'foo'), 'Running')
+    print(api.spans.report()['Starting container']['running']['p99'])
+"""
+
+import calendar
+import collections
+import math
+import re
+import threading
+
+
+TIMESTAMP = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'(Z|([+-])(\d\d):(\d\d))$'
+)
+
+PHASES = ('submit', 'queued', 'running', 'wait', 'total')
+
+
+def parse_timestamp(value):
+    """
+    Return epoch seconds for an LXD timestamp, or None.
+
+    LXD timestamps are RFC 3339 with nanoseconds, such as
+    ``2016-06-23T15:05:45.435413676+02:00``.
+    """
+    match = TIMESTAMP.match(value or '')
+    if not match:
+        return None
+
+    groups = match.groups()
+    seconds = calendar.timegm([int(g) for g in groups[:6]])
+    seconds += float(groups[6] or 0)
+
+    if groups[8]:
+        offset = int(groups[9]) * 3600 + int(groups[10]) * 60
+        seconds -= offset if groups[8] == '+' else -offset
+
+    return seconds
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list."""
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class OperationSpan(object):
+    """
+    Timestamps of an async operation, in epoch seconds.
+
+    .. attribute:: name
+
+        Operation type, the description of the operation if LXD provides
+        it, otherwise the method and operation class.
+
+    .. attribute:: sent
+
+        When the request was sent, after waiting for a limiter slot.
+
+    .. attribute:: created_at
+
+        When the operation was created, from the metadata.
+
+    .. attribute:: started_at
+
+        The ``updated_at`` of the operation when the request returned.
+
+    .. attribute:: updated_at
+
+        The ``updated_at`` of the operation when the wait call returned.
+
+    .. attribute:: waited
+
+        When the wait call returned, None until then.
+    """
+
+    def __init__(self, name, sent, metadata):
+        """Construct a span with the metadata of the created operation."""
+        self.name = name
+        self.sent = sent
+        self.created_at = parse_timestamp(metadata.get('created_at'))
+        self.started_at = parse_timestamp(metadata.get('updated_at'))
+        self.updated_at = None
+        self.waited = None
+
+    @classmethod
+    def from_result(cls, result, sent):
+        """Return a span for an :class:`~lxdapi.api.APIResult`."""
+        name = result.metadata.get('description') or '%s %s' % (
+            result.request.method, result.metadata.get('class'))
+        return cls(name, sent, result.metadata)
+
+    def finish(self, metadata, waited):
+        """Complete the span with the metadata returned by the wait call."""
+        self.updated_at = parse_timestamp(metadata.get('updated_at'))
+        self.waited = waited
+
+    def phases(self):
+        """Return a dict of phase name to seconds, None when unknown."""
+        points = [
+            self.sent,
+            self.created_at,
+            self.started_at,
+            self.updated_at,
+            self.waited,
+        ]
+        phases = [
+            None if start is None or end is None else end - start
+            for start, end in zip(points, points[1:])
+        ]
+        phases.append(None if self.waited is None else self.waited - self.sent)
+        return dict(zip(PHASES, phases))
+
+
+class SpanAggregator(object):
+    """Thread-safe collection of :class:`OperationSpan` by name."""
+
+    def __init__(self):
+        self.spans = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        """Add a completed span."""
+        with self.lock:
+            self.spans[span.name].append(span)
+
+    def report(self, percents=(50, 99)):
+        """
+        Return percentiles of each phase for each operation type.
+
+        Return a dict of names to dicts of phases to dicts such as
+        ``{'count': 12, 'p50': 0.1, 'p99': 0.4}``, phases without any known
+        value are omitted.
+        """
+        with self.lock:
+            spans = dict((k, list(v)) for k, v in self.spans.items())
+
+        return dict(
+            (name, self.summarize(values, percents))
+            for name, values in spans.items()
+        )
+
+    @staticmethod
+    def summarize(spans, percents):
+        """Return the percentiles of each phase of spans."""
+        summary = {}
+
+        for phase in PHASES:
+            values = sorted(
+                p[phase] for p in (s.phases() for s in spans)
+                if p[phase] is not None
+            )
+            if values:
+                summary[phase] = dict(count=len(values))
+                for percent in percents:
+                    summary[phase]['p%s' % percent] = percentile(
+                        values, percent)
+
+        return summary
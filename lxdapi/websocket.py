@@ -0,0 +1,316 @@
+"""
+Minimal websocket client for LXD operation websockets.
+
+LXD exposes the stdio of exec operations as websockets, this module
+implements just enough of RFC 6455 to use them over a socket returned by
+:meth:`lxdapi.api.API.connect`: the client handshake, masked client frames,
+fragmented messages, ping and close frames.
+
+:class:`WebSocket` does not block on reads as long as :meth:`recv()` is only
+called when the socket is readable, nor on writes with :meth:`queue()` and
+:meth:`flush()` on a non-blocking socket, so that many websockets can be
+multiplexed in a single thread with ``select``.
+"""
+
+import base64
+import binascii
+import errno
+import os
+import socket
+import ssl
+import struct
+
+import requests
+
+from .deadline import DeadlineExceeded
+
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class WebSocketException(Exception):
+    """Raised when the websocket handshake fails."""
+
+
+def mask(key, payload):
+    """Return payload masked, or unmasked, with a 4 bytes key."""
+    length = len(payload)
+    if not length:
+        return b''
+
+    keys = bytes(key) * (length // 4 + 1)
+    return _to_bytes(_from_bytes(payload) ^ _from_bytes(keys[:length]), length)
+
+
+def _from_bytes(data):
+    """Return data as a big endian integer."""
+    if hasattr(int, 'from_bytes'):
+        return int.from_bytes(data, 'big')
+    return int(binascii.hexlify(data), 16)
+
+
+def _to_bytes(value, length):
+    """Return a big endian integer as length bytes."""
+    if hasattr(value, 'to_bytes'):
+        return value.to_bytes(length, 'big')
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def frame(opcode, payload):
+    """Return a final, masked client frame."""
+    length = len(payload)
+
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+
+    key = os.urandom(4)
+    return header + key + mask(key, payload)
+
+
+def parse_header(buffer):
+    """Return (fin, opcode, offset, length, key) or None if incomplete."""
+    if len(buffer) < 2:
+        return None
+
+    first, second = struct.unpack('!BB', buffer[:2])
+    length = second & 0x7f
+    offset = {126: 4, 127: 10}.get(length, 2)
+    offset += 4 if second & 0x80 else 0
+
+    if len(buffer) < offset:
+        return None
+
+    if length == 126:
+        length = struct.unpack('!H', buffer[2:4])[0]
+    elif length == 127:
+        length = struct.unpack('!Q', buffer[2:10])[0]
+
+    key = buffer[offset - 4:offset] if second & 0x80 else None
+    return first & 0x80, first & 0x0f, offset, length, key
+
+
+def parse_frame(buffer):
+    """Return (fin, opcode, payload, rest) or None if incomplete."""
+    header = parse_header(buffer)
+    if header is None:
+        return None
+
+    fin, opcode, offset, length, key = header
+    if len(buffer) < offset + length:
+        return None
+
+    payload = buffer[offset:offset + length]
+    if key:
+        payload = mask(key, payload)
+
+    return fin, opcode, payload, buffer[offset + length:]
+
+
+class WebSocket(object):
+    """
+    Client websocket, use :meth:`connect()` to open one.
+
+    .. attribute:: closed
+
+        True once the server closed the websocket or the connection.
+    """
+
+    def __init__(self, sock, buffer=b'', deadline=None):
+        """Construct a WebSocket with a socket which did the handshake."""
+        self.sock = sock
+        self.deadline = deadline
+        self.buffer = buffer
+        self.closed = False
+        self.fragments = []
+        self.outgoing = b''
+
+    @classmethod
+    def connect(cls, api, url, deadline=None):
+        """
+        Connect to a websocket url of an :class:`~lxdapi.api.API`.
+
+        With a :class:`~lxdapi.deadline.Deadline`, the remaining budget is
+        the socket timeout, and :class:`~lxdapi.deadline.DeadlineExceeded`
+        is raised if it expired or once the socket times out.
+
+        Example::
+
+            WebSocket.connect(api, '%s/websocket?secret=%s' % (
+                result.data['operation'], secret))
+        """
+        url = requests.compat.urlparse(api.format_url(url))
+
+        try:
+            return cls.handshake(api, url, deadline)
+        except socket.timeout as e:
+            raise cls.exceeded(url.path, deadline, e)
+
+    @classmethod
+    def handshake(cls, api, url, deadline=None):
+        """Return a WebSocket for a parsed url once the handshake is done."""
+        sock = api.connect(deadline.timeout(url.path) if deadline else None)
+
+        try:
+            sock.sendall(cls.format_handshake(url))
+            return cls(sock, cls.read_handshake(sock, url), deadline)
+        except Exception:
+            sock.close()
+            raise
+
+    @staticmethod
+    def exceeded(description, deadline, error):
+        """Return a DeadlineExceeded for a socket timeout."""
+        return DeadlineExceeded('%s: deadline of %ss exceeded: %s' % (
+            description, deadline.seconds if deadline else None, error))
+
+    @staticmethod
+    def format_handshake(url):
+        """Return the handshake request for an url."""
+        return '\r\n'.join([
+            'GET %s?%s HTTP/1.1' % (url.path, url.query),
+            'Host: lxd',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: %s' % base64.b64encode(
+                os.urandom(16)).decode('ascii'),
+            'Sec-WebSocket-Version: 13',
+            '',
+            '',
+        ]).encode('latin-1')
+
+    @staticmethod
+    def read_handshake(sock, url):
+        """Read the handshake response, return the bytes received after it."""
+        response = b''
+
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise WebSocketException('%s: connection closed' % url.path)
+            response += data
+
+        head, rest = response.split(b'\r\n\r\n', 1)
+        status = head.split(b'\r\n', 1)[0].decode('latin-1')
+
+        if status.split(' ')[1:2] != ['101']:
+            raise WebSocketException('%s: %s' % (url.path, status))
+
+        return rest
+
+    def fileno(self):
+        """Return the file descriptor of the socket, for select."""
+        return self.sock.fileno()
+
+    def send(self, payload, opcode=OPCODE_BINARY):
+        """Send payload in a single frame."""
+        self.sock.sendall(frame(opcode, payload))
+
+    def queue(self, payload, opcode=OPCODE_BINARY):
+        """Buffer a frame for :meth:`flush()`, a close frame closes."""
+        self.outgoing += frame(opcode, payload)
+        self.closed |= opcode == OPCODE_CLOSE
+
+    def flush(self):
+        """
+        Send buffered frames as far as the socket accepts them.
+
+        Return True once nothing is left to send. This doesn't block if the
+        socket is non-blocking.
+        """
+        if self.outgoing:
+            self.outgoing = self.outgoing[self.write(self.outgoing):]
+
+        return not self.outgoing
+
+    def write(self, data):
+        """Send data once, return the number of bytes sent, 0 if busy."""
+        try:
+            return self.sock.send(data)
+        except socket.timeout as e:
+            raise self.exceeded('Websocket write', self.deadline, e)
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK or isinstance(e, ssl.SSLWantWriteError):
+                return 0
+            raise
+
+    def recv(self, size=65536):
+        """
+        Read the socket once, return the list of complete messages.
+
+        Messages are (opcode, payload) tuples, ping and close frames are
+        answered and not returned.
+        """
+        data = self.sock.recv(size)
+        if not data:
+            self.closed = True
+
+        self.buffer += data
+        return self.pending()
+
+    def pending(self):
+        """
+        Return the list of complete messages already buffered.
+
+        Frames sent right after the handshake may be received with it, call
+        this before waiting for the socket to be readable.
+        """
+        return list(self.parse())
+
+    def parse(self):
+        """Yield the complete messages from the buffer."""
+        parsed = parse_frame(self.buffer)
+
+        while parsed:
+            fin, opcode, payload, self.buffer = parsed
+            message = self.handle(fin, opcode, payload)
+            if message:
+                yield message
+            parsed = parse_frame(self.buffer)
+
+    def handle(self, fin, opcode, payload):
+        """Handle a frame, return a message if it completes one."""
+        if opcode == OPCODE_PING:
+            self.reply(payload, OPCODE_PONG)
+        elif opcode == OPCODE_CLOSE:
+            self.closed = True
+            self.reply(payload[:2], OPCODE_CLOSE)
+        elif opcode != OPCODE_PONG:
+            self.fragments.append((opcode, payload))
+            if fin:
+                return self.assemble()
+
+    def assemble(self):
+        """Return the message made of the fragments received so far."""
+        opcode = self.fragments[0][0]
+        payload = b''.join(p for o, p in self.fragments)
+        self.fragments = []
+        return opcode, payload
+
+    def reply(self, payload, opcode):
+        """Send a control frame, ignore errors if the peer is gone."""
+        try:
+            self.send(payload, opcode)
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        """Send a close frame, unless the websocket is already closed."""
+        if not self.closed:
+            self.closed = True
+            self.reply(b'', OPCODE_CLOSE)
+
+    def shutdown(self):
+        """Close the websocket and its socket."""
+        self.close()
+        self.sock.close()
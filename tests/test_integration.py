@@ -1,6 +1,15 @@
 import os
+import tarfile
+import tempfile
+import threading
+import time
 
 from lxdapi import lxd
+from lxdapi.deadline import Deadline, DeadlineExceeded
+from lxdapi.image import ImageBuilder
+from lxdapi.limiter import Limiter, Slot
+from lxdapi.plan import Plan
+from lxdapi.timing import SpanAggregator
 
 api = lxd.API.factory()
 busybox = os.path.join(
@@ -11,6 +20,15 @@ busybox_fingerprint = lxd.image_get_fingerprint(busybox)
 busybox_alias = 'lxdapitestbusybox'
 
 
+def test_image_get_fingerprints():
+    split = (busybox, busybox)
+    fingerprints = lxd.image_get_fingerprints([busybox, split], processes=2)
+
+    assert fingerprints[busybox] == busybox_fingerprint
+    assert fingerprints[split] == lxd.image_get_fingerprint(split)
+    assert fingerprints[split] != busybox_fingerprint
+
+
 def test_images():
     # Clean up
     lxd.image_absent(api, busybox_fingerprint)
@@ -34,12 +52,39 @@ def test_images():
     assert not lxd.image_absent(api, busybox_fingerprint)
 
 
-def test_container():
+def test_image_split():
+    source = tempfile.mkdtemp()
+    with tarfile.open(busybox) as tar:
+        tar.extractall(source)
+
+    metadata = os.path.join(source, 'metadata.tar')
+    with tarfile.open(metadata, 'w') as tar:
+        tar.add(os.path.join(source, 'metadata.yaml'), 'metadata.yaml')
+    rootfs = os.path.join(source, 'rootfs.tar')
+    with tarfile.open(rootfs, 'w') as tar:
+        tar.add(os.path.join(source, 'rootfs'), '.')
+
+    split = (metadata, rootfs)
+    fingerprint = lxd.image_get_fingerprints([split])[split]
+    lxd.image_absent(api, fingerprint)
+
+    # Should upload the split image
+    assert lxd.image_present(api, split)
+    assert lxd.image_get(api, fingerprint)
+
+    # Should not do anything, return False
+    assert not lxd.image_present(api, split, fingerprint)
+
+    assert lxd.image_absent(api, fingerprint)
+
+
+def image_setup():
     if not os.environ.get('TEST_ONLINE', False):
         lxd.image_present(api, busybox)
         lxd.image_alias_present(api, busybox_alias, busybox_fingerprint)
 
-    name = 'lxdapi-test-container'
+
+def container_config(name):
     config = dict(
         name=name,
         source=dict(
@@ -55,6 +100,15 @@ def test_container():
         config['source']['server'] = 'https://images.linuxcontainers.org'
         config['source']['alias'] = 'ubuntu/xenial/amd64'
 
+    return config
+
+
+def test_container():
+    image_setup()
+
+    name = 'lxdapi-test-container'
+    config = container_config(name)
+
     # Clean potential leftover from other test run
     lxd.container_absent(api, lxd.container_get(api, name))
     assert not lxd.container_get(api, name)
@@ -92,3 +146,366 @@ def test_container():
 
     # No change should happen, should return False
     assert not lxd.container_absent(api, lxd.container_get(api, name))
+
+
+def test_containers_absent():
+    image_setup()
+
+    names = ['lxdapi-test-teardown-%s' % i for i in range(3)]
+
+    for name in names:
+        lxd.container_apply_config(
+            api,
+            lxd.container_get(api, name),
+            container_config(name),
+        )
+        lxd.container_apply_status(
+            api,
+            lxd.container_get(api, name),
+            'Running'
+        )
+
+    # Should kill and destroy all containers, reporting their timings
+    report = lxd.containers_absent(api, names, timeout=0, force=True)
+    assert sorted(report.keys()) == names
+    assert report.total >= max(report.values())
+
+    for name in names:
+        assert not lxd.container_get(api, name)
+
+    # No change should happen, should return an empty report
+    assert not lxd.containers_absent(api, names)
+
+
+def test_files():
+    image_setup()
+
+    name = 'lxdapi-test-files'
+    lxd.container_absent(api, lxd.container_get(api, name))
+    lxd.container_apply_config(api, False, container_config(name))
+
+    source = tempfile.mkdtemp()
+    os.makedirs(os.path.join(source, 'sub'))
+    with open(os.path.join(source, 'sub', 'foo'), 'w') as f:
+        f.write('foo')
+
+    # Should create the directories and upload the file
+    assert lxd.files_push_present(api, name, '/root/test', source)
+
+    # No change should happen, should return False
+    assert not lxd.files_push_present(api, name, '/root/test', source)
+
+    # Should upload the file with zero-copy
+    with open(os.path.join(source, 'sub', 'foo'), 'w') as f:
+        f.write('bar')
+    assert lxd.file_push_present(
+        api, name, '/root/test/sub/foo', os.path.join(source, 'sub', 'foo'),
+        sendfile=True)
+
+    # Should download the file, and then do nothing
+    target = os.path.join(source, 'pulled')
+    assert lxd.file_pull(api, name, '/root/test/sub/foo', target)
+    assert not lxd.file_pull(api, name, '/root/test/sub/foo', target)
+
+    with open(target) as f:
+        assert f.read() == 'bar'
+
+    # Should fix the mode of a pulled file with the same content
+    os.chmod(target, 0o601)
+    assert lxd.file_pull(api, name, '/root/test/sub/foo', target)
+    assert not lxd.file_pull(api, name, '/root/test/sub/foo', target)
+    assert os.stat(target).st_mode & 0o777 == (
+        os.stat(os.path.join(source, 'sub', 'foo')).st_mode & 0o777)
+
+    # Should fix the mode of an existing directory
+    os.chmod(os.path.join(source, 'sub'), 0o700)
+    assert lxd.files_push_present(api, name, '/root/test', source)
+    assert not lxd.files_push_present(api, name, '/root/test', source)
+
+    lxd.container_absent(api, lxd.container_get(api, name))
+
+
+def test_exec():
+    image_setup()
+
+    names = ['lxdapi-test-exec-%s' % i for i in range(2)]
+
+    for name in names:
+        lxd.container_apply_config(
+            api,
+            lxd.container_get(api, name),
+            container_config(name),
+        )
+        lxd.container_apply_status(
+            api,
+            lxd.container_get(api, name),
+            'Running'
+        )
+
+    # Should capture the output and the exit code
+    execution = lxd.container_exec(
+        api, names[0], ['sh', '-c', 'cat; echo err >&2; exit 3'], stdin=b'in')
+    assert execution.return_code == 3
+    assert execution.stdout == b'in'
+    assert execution.stderr == b'err\n'
+
+    # Should not deadlock on stdin larger than the socket buffers
+    stdin = os.urandom(8 * 1024 * 1024)
+    execution = lxd.container_exec(api, names[0], ['cat'], stdin=stdin)
+    assert execution.return_code == 0
+    assert execution.stdout == stdin
+
+    # Should run in all containers, streaming output to the callback
+    output = []
+    executions = lxd.containers_exec(
+        api, [(name, ['echo', name]) for name in names],
+        on_stdout=output.append)
+    assert [e.return_code for e in executions] == [0, 0]
+    assert sorted(output) == sorted(('%s\n' % n).encode() for n in names)
+
+    lxd.containers_absent(api, names, timeout=0, force=True)
+
+
+def test_image_build():
+    source = tempfile.mkdtemp()
+    with tarfile.open(busybox) as tar:
+        tar.extractall(source)
+
+    builder = ImageBuilder(source, codec='gzip')
+
+    # Should build and upload the image
+    assert lxd.image_build_present(api, builder)
+    assert lxd.image_get(api, builder.fingerprint)
+
+    # Build is reproducible, should not do anything
+    assert not lxd.image_build_present(api, ImageBuilder(source))
+
+    # Should not even build with the fingerprint of a previous build
+    skipped = ImageBuilder(source)
+    assert not lxd.image_build_present(
+        api, skipped, fingerprint=builder.fingerprint)
+    assert skipped.fingerprint is None
+
+    # Should be compatible with image_get_fingerprint
+    path = os.path.join(tempfile.mkdtemp(), 'image.tar.gz')
+    with open(path, 'wb') as f:
+        assert ImageBuilder(source).write(f) == builder.fingerprint
+    assert lxd.image_get_fingerprint(path) == builder.fingerprint
+
+    assert lxd.image_absent(api, builder.fingerprint)
+
+
+def test_plan():
+    names = ['lxdapi-test-plan-%s' % i for i in range(3)]
+    lxd.containers_absent(api, names, timeout=0, force=True)
+
+    plan = Plan(api)
+    if not os.environ.get('TEST_ONLINE', False):
+        plan.image(busybox, busybox_fingerprint, aliases=[busybox_alias])
+    for name in names:
+        plan.container(container_config(name), status='Running')
+
+    # Should refuse a conflicting declaration of the same node
+    try:
+        plan.container(container_config(names[0]), status='Stopped')
+    except Exception as e:
+        assert 'Conflicting declarations of status:' in str(e)
+    else:
+        assert False, 'Conflicting declaration accepted'
+
+    # Should make a container require the image of its source fingerprint
+    if not os.environ.get('TEST_ONLINE', False):
+        other = Plan(api)
+        other.image(busybox)
+        other.container(dict(name=names[0], source=dict(
+            type='image', fingerprint=busybox_fingerprint)))
+        other.resolve()
+        assert other.nodes['container:%s' % names[0]].requires == set([
+            'image:%s' % busybox])
+
+    # Should create and start all containers
+    report = plan.apply(processes=4)
+    for name in names:
+        assert report['container:%s' % name]
+        assert report['status:%s' % name]
+    assert report.critical_path[-1][0].startswith('status:')
+
+    # No change should happen
+    assert not plan.apply().changed()
+
+    lxd.containers_absent(api, names, timeout=0, force=True)
+
+
+def test_limiter():
+    limiter = Limiter(limit=1)
+    limited = lxd.API.factory(
+        limiter=limiter,
+        host_limiter=Limiter.host('/var/lib/lxd/unix.socket'),
+    )
+    names = ['lxdapi-test-limiter-%s' % i for i in range(4)]
+
+    # Should queue concurrent requests behind the limit of 1
+    acquired = limiter.acquire()
+    threading.Timer(0.2, limiter.release, (acquired,)).start()
+    assert not lxd.containers_absent(limited, names)
+    stats = limiter.stats()
+    assert stats['max_queue_wait'] >= 0.1
+    assert stats['queue_wait'] >= stats['max_queue_wait']
+    assert stats['in_flight'] == stats['queued'] == 0
+    assert limited.host_limiter.stats()['in_flight'] == 0
+
+
+def test_limiter_fifo():
+    limiter = Limiter(limit=1)
+    order = []
+
+    def acquire(i):
+        acquired = limiter.acquire()
+        order.append(i)
+        limiter.release(acquired)
+
+    # Should serve waiters in arrival order
+    acquired = limiter.acquire()
+    threads = []
+    for i in range(4):
+        threads.append(threading.Thread(target=acquire, args=(i,)))
+        threads[-1].start()
+        while limiter.stats()['queued'] <= i:
+            time.sleep(0.01)
+    limiter.release(acquired)
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2, 3]
+
+
+def test_limiter_deadline():
+    limiter = Limiter(limit=1)
+    acquired = limiter.acquire()
+
+    # Should stop waiting for a slot once the deadline expired
+    try:
+        limiter.acquire(Deadline(0.1))
+    except DeadlineExceeded:
+        pass
+    else:
+        assert False, 'DeadlineExceeded not raised'
+
+    # Should not block the queue behind the abandoned place
+    limiter.release(acquired)
+    limiter.release(limiter.acquire(Deadline(1)))
+    assert limiter.stats()['queued'] == 0
+
+    # Should not reduce the limit for requests which expired client side
+    limiter = Limiter(limit=8)
+    for i in range(3):
+        try:
+            with Slot([limiter]):
+                Deadline(0).check('request')
+        except DeadlineExceeded:
+            pass
+    assert limiter.stats()['limit'] == 8
+
+
+def test_limiter_aimd():
+    limiter = Limiter(limit=2, latency=1)
+
+    # Should grow the limit by about one per limit of fast responses
+    for i in range(4):
+        limiter.release(limiter.acquire(), latency=0.01)
+    assert 3 < limiter.limit < 4
+
+    # Should halve the limit once for slow responses of the same round trip
+    limit = limiter.limit
+    acquired = [limiter.acquire() for i in range(3)]
+    for value in acquired:
+        limiter.release(value, latency=2)
+    assert limiter.limit == limit / 2
+
+    # Should halve it again in the next round trip, down to the minimum
+    time.sleep(0.01)
+    limiter.release(limiter.acquire(), error=True)
+    assert limiter.limit == 1
+
+
+def test_spans():
+    image_setup()
+
+    timed = lxd.API.factory()
+    timed.spans = SpanAggregator()
+    name = 'lxdapi-test-spans'
+
+    lxd.container_apply_config(
+        timed, lxd.container_get(timed, name), container_config(name))
+    lxd.container_apply_status(
+        timed, lxd.container_get(timed, name), 'Running')
+    lxd.container_absent(timed, lxd.container_get(timed, name), timeout=0)
+
+    # Should have a timing breakdown for each waited operation
+    report = timed.spans.report()
+    assert len(report) >= 3
+    for phases in report.values():
+        assert phases['total']['p50'] <= phases['total']['p99']
+        assert phases['running']['count'] == phases['total']['count']
+
+
+def test_image_export():
+    lxd.image_present(api, busybox)
+    path = os.path.join(tempfile.mkdtemp(), 'busybox.tar.xz')
+
+    # Should resume the download of a partial file
+    with open(busybox, 'rb') as source, open(path + '.part', 'wb') as f:
+        f.write(source.read(1024))
+    assert lxd.image_export(api, busybox_fingerprint, path)
+    assert lxd.image_get_fingerprint(path) == busybox_fingerprint
+    assert not os.path.exists(path + '.part')
+
+    # Should not do anything, return False
+    assert not lxd.image_export(api, busybox_fingerprint, path)
+
+    # Should move a partial file which is already the whole image
+    os.rename(path, path + '.part')
+    assert lxd.image_export(api, busybox_fingerprint, path)
+    assert lxd.image_get_fingerprint(path) == busybox_fingerprint
+    assert not os.path.exists(path + '.part')
+
+    # Should restart when the range of a corrupt partial file is invalid
+    with open(path + '.part', 'wb') as f:
+        f.write(b'0' * os.path.getsize(busybox))
+    os.remove(path)
+    assert lxd.image_export(api, busybox_fingerprint, path)
+    assert lxd.image_get_fingerprint(path) == busybox_fingerprint
+    assert not os.path.exists(path + '.part')
+
+
+def test_deadline():
+    image_setup()
+
+    name = 'lxdapi-test-deadline'
+    lxd.container_absent(api, lxd.container_get(api, name), timeout=0)
+
+    # Should complete within the budget
+    deadline = Deadline(60)
+    assert lxd.container_apply_config(
+        api, False, container_config(name), deadline=deadline)
+    assert lxd.container_apply_status(
+        api, lxd.container_get(api, name), 'Running', deadline=deadline)
+    assert not deadline.expired
+
+    # Should fail fast once the budget is spent
+    deadline = Deadline(0.1)
+    time.sleep(0.2)
+    try:
+        lxd.container_absent(
+            api, lxd.container_get(api, name), deadline=deadline)
+    except DeadlineExceeded:
+        pass
+    else:
+        assert False, 'DeadlineExceeded not raised'
+    assert lxd.container_get(api, name)
+
+    # Should leave time to kill and delete the container within the budget
+    deadline = Deadline(10)
+    assert lxd.container_absent(
+        api, lxd.container_get(api, name), force=True, deadline=deadline)
+    assert not deadline.expired
+    assert not lxd.container_get(api, name)